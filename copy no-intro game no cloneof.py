@@ -1,56 +1,180 @@
-import os, sys, re, shutil, threading, urllib.request, json, xml.etree.ElementTree as ET 
+import os, sys, mmap, threading, time, hashlib, sqlite3, zlib, zipfile, xml.etree.ElementTree as ET 
 import tkinter as tk
 from tkinter import Tk, Frame, Label, Button, Listbox, Scrollbar, Text, END, filedialog, StringVar, Entry, messagebox, ttk
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import namedtuple
+from romtools_common import (CACHE_DIR, DAT_CACHE, SOURCE_INDEX, TRANSFER_MODES, RunMetrics, fetch_json,
+                             iter_xml_elements, normalize_text, open_url, transfer_file)
+from romtools_ui import Finished, ItemResult, LogLine, Progress, Started, UiChannel
 
 API_URL = "https://api.github.com/repos/longhai/xml/contents/?ref=main"
 
 # -----------------------
-# Helpers
+# Hash file nguồn (CRC32 + SHA1) / CRC trong ZIP để ghép theo checksum
 # -----------------------
-def fetch_url(url, timeout=30, retries=3):
-    for i in range(retries):
-        try:
-            req = urllib.request.Request(url, headers={"User-Agent": "python-urllib/3"})
-            with urllib.request.urlopen(req, timeout=timeout) as resp:
-                return resp.read()
-        except Exception as e:
-            if i == retries - 1:
-                raise e
-            threading.Event().wait(1)
-
-def fetch_json(url):
-    return json.loads(fetch_url(url).decode("utf-8"))
-
-def fetch_text(url):
-    data = fetch_url(url)
-    try:
-        return data.decode("utf-8")
-    except UnicodeDecodeError:
-        return data.decode("latin-1")
-
-def normalize_text(s):
-    if not s:
-        return ""
-    s = s.lower()
-    s = re.sub(r"[^a-z0-9\u00C0-\u024f\s]", " ", s)
-    return re.sub(r"\s+", " ", s).strip()
+MATCH_MODES = ("name", "hash", "zip")
+HASH_CHUNK = 4 * 1024 * 1024
+
+def hash_file(path):
+    """Trả về (crc32, sha1) dạng hex chữ thường; đọc qua mmap theo khối lớn (zlib/hashlib nhả GIL)."""
+    crc, sha1 = 0, hashlib.sha1()
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                view = memoryview(mm)
+                try:
+                    for i in range(0, len(view), HASH_CHUNK):
+                        block = view[i:i + HASH_CHUNK]
+                        crc = zlib.crc32(block, crc)
+                        sha1.update(block)
+                        block.release()
+                finally:
+                    view.release()
+    return f"{crc:08x}", sha1.hexdigest()
+
+def read_zip_members(path):
+    """(crc32, size) của từng file trong ZIP, chỉ đọc central directory (không giải nén)."""
+    with zipfile.ZipFile(path) as zf:
+        return [(f"{info.CRC:08x}", info.file_size) for info in zf.infolist() if not info.is_dir()]
+
+class HashDatabase:
+    """Lưu CRC32/SHA1 của file nguồn giữa các lần chạy, hợp lệ khi size + mtime_ns còn khớp."""
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = None
+
+    def _conn(self):
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            db.execute("CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+                       "crc TEXT, sha1 TEXT)")
+            db.execute("CREATE TABLE IF NOT EXISTS zips (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+                       "members TEXT)")
+            self._db = db
+        return self._db
+
+    @staticmethod
+    def _stat_entries(entries):
+        """stat lại từng file: size/mtime của SourceIndex có thể cũ khi file bị ghi đè tại chỗ."""
+        fresh = []
+        for path, *_ in entries:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            fresh.append((path, st.st_size, st.st_mtime_ns))
+        return fresh
+
+    def hash_entries(self, entries, workers=4, log_callback=None):
+        """`entries` là (path, ...) từ SourceIndex; trả về {path: (crc, sha1, size)}.
+
+        Chỉ hash file mới hoặc đã đổi (theo size + mtime_ns stat lại), chạy song song trên `workers` luồng.
+        """
+        entries = self._stat_entries(entries)
+        with self._lock:
+            db = self._conn()
+            stored = {}
+            for path, size, mtime_ns in entries:
+                row = db.execute("SELECT size, mtime_ns, crc, sha1 FROM hashes WHERE path=?", (path,)).fetchone()
+                if row and row[0] == size and row[1] == mtime_ns:
+                    stored[path] = (row[2], row[3], size)
+
+        todo = [e for e in entries if e[0] not in stored]
+        if log_callback:
+            log_callback(f"Hash: {len(stored)} file từ cache, {len(todo)} file cần tính.")
+        result = dict(stored)
+        fresh = []
+        with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="hash") as exe:
+            futures = {exe.submit(hash_file, e[0]): e for e in todo}
+            for future in as_completed(futures):
+                path, size, mtime_ns = futures[future]
+                try:
+                    crc, sha1 = future.result()
+                except OSError as e:
+                    if log_callback:
+                        log_callback(f"[ERR HASH] {os.path.basename(path)}: {e}")
+                    continue
+                result[path] = (crc, sha1, size)
+                fresh.append((path, size, mtime_ns, crc, sha1))
+
+        if fresh:
+            with self._lock:
+                db = self._conn()
+                with db:
+                    db.executemany("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)", fresh)
+        return result
+
+    def zip_entries(self, entries, workers=4, log_callback=None):
+        """Như hash_entries nhưng cho file .zip: trả về {path: [(crc, size), ...]} từ central directory."""
+        entries = self._stat_entries(e for e in entries if e[0].lower().endswith(".zip"))
+        with self._lock:
+            db = self._conn()
+            result = {}
+            for path, size, mtime_ns in entries:
+                row = db.execute("SELECT size, mtime_ns, members FROM zips WHERE path=?", (path,)).fetchone()
+                if row and row[0] == size and row[1] == mtime_ns:
+                    result[path] = [(crc, int(n)) for crc, n in
+                                    (m.split(":") for m in row[2].split(";") if m)]
+
+        todo = [e for e in entries if e[0] not in result]
+        if log_callback:
+            log_callback(f"ZIP: {len(result)} file từ cache, {len(todo)} file cần đọc.")
+        fresh = []
+        with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="zip") as exe:
+            futures = {exe.submit(read_zip_members, e[0]): e for e in todo}
+            for future in as_completed(futures):
+                path, size, mtime_ns = futures[future]
+                try:
+                    members = future.result()
+                except (OSError, zipfile.BadZipFile) as e:
+                    if log_callback:
+                        log_callback(f"[ERR ZIP] {os.path.basename(path)}: {e}")
+                    continue
+                result[path] = members
+                fresh.append((path, size, mtime_ns, ";".join(f"{crc}:{n}" for crc, n in members)))
+
+        if fresh:
+            with self._lock:
+                db = self._conn()
+                with db:
+                    db.executemany("INSERT OR REPLACE INTO zips VALUES (?, ?, ?, ?)", fresh)
+        return result
+
+HASH_DB = HashDatabase(os.path.join(CACHE_DIR, "hashes.sqlite"))
 
 # -----------------------
 # Parse XML: parent + clone tùy chọn
 # -----------------------
-def parse_xml_games(xml_text, skip_keywords=None, include_clones=False):
-    """Lấy danh sách game từ XML (chỉ parent hoặc cả clone tùy chọn)."""
+class Game:
+    """Một <game> của DAT. `__slots__` + tên interned: hàng triệu bản ghi không kèm dict riêng.
+
+    `roms` là tuple các (name, crc, sha1, size) của thẻ <rom> (checksum chữ thường, rỗng nếu DAT không có).
+    """
+    __slots__ = ("name", "roms")
+
+    def __init__(self, name, roms):
+        self.name = sys.intern(name)
+        self.roms = tuple(map(tuple, roms))
+
+def iter_games(xml_source, skip_keywords=None, include_clones=False):
+    """Duyệt game theo luồng, lọc clone và từ khóa bỏ qua ngay trên từng bản ghi."""
+    keywords = [k.strip().lower() for k in skip_keywords.split(",") if k.strip()] if skip_keywords else []
+    for g in iter_xml_elements(xml_source, "game"):
+        if not include_clones and g.get("cloneof"):
+            continue
+        name = g.get("name", "")
+        if keywords and any(kw in name.lower() for kw in keywords):
+            continue
+        roms = [(r.get("name", ""), (r.get("crc") or "").lower(), (r.get("sha1") or "").lower(),
+                 int(r.get("size") or 0)) for r in g.iter("rom")]
+        yield Game(name, roms)
+
+def parse_xml_games(xml_source, skip_keywords=None, include_clones=False):
+    """Lấy danh sách game từ XML (str, bytes hoặc file object; chỉ parent hoặc cả clone tùy chọn)."""
     try:
-        root = ET.fromstring(xml_text)
-        games = []
-        for g in root.iter("game"):
-            if not include_clones and g.get("cloneof"):
-                continue
-            games.append({"name": g.get("name")})
-        if skip_keywords:
-            keywords = [k.strip().lower() for k in skip_keywords.split(",") if k.strip()]
-            games = [g for g in games if all(kw not in g["name"].lower() for kw in keywords)]
-        return games
+        return list(iter_games(xml_source, skip_keywords, include_clones))
     except ET.ParseError:
         return []
 
@@ -58,67 +182,187 @@ def parse_xml_games(xml_text, skip_keywords=None, include_clones=False):
 # Core copy processor
 # -----------------------
 class CopyOnlyProcessor:
-    def __init__(self, source_dir, dest_dir, xml_file, games, extensions=None):
+    """Copy file nguồn khớp với DAT vào thư mục đích.
+
+    Ghép theo tên giữ nguyên tên file nguồn; ghép theo hash/zip ghi file dưới tên chuẩn của DAT
+    (tên <rom>, hoặc tên game + phần mở rộng). Ở chế độ hash bộ lọc phần mở rộng bị bỏ qua để
+    ROM rời (không nén) cũng được hash.
+    """
+    def __init__(self, source_dir, dest_dir, xml_file, games, extensions=None, workers=4, transfer_mode="copy",
+                 source_index=None, match_mode="name", hash_db=None, metrics=None):
         self.source_dir = source_dir
         self.dest_dir = dest_dir
         self.xml_file = xml_file
         self.games = games
         self.extensions = extensions
+        self.workers = max(1, workers)
+        self.transfer_mode = transfer_mode
+        self.source_index = source_index or SOURCE_INDEX
+        self.match_mode = match_mode
+        self.hash_db = hash_db or HASH_DB
+        self.metrics = metrics or RunMetrics("copy")
+        self.output_dir = None
         self.copied_count = 0
+        self.worker_stats = {}  # tên luồng -> [số file, số byte, số giây]
         self.lock = threading.Lock()
 
-    def process(self, progress_callback=None, log_callback=None):
+    def process(self, events=None):
+        """Chạy copy; tiến độ/kết quả được publish lên `events` (UiChannel hoặc tương tự)."""
+        publish = events.publish if events else (lambda event: None)
         dst = os.path.join(
             self.dest_dir,
             os.path.splitext(os.path.basename(self.xml_file))[0]
         ) if self.xml_file else self.dest_dir
         os.makedirs(dst, exist_ok=True)
 
-        files = [
-            os.path.join(self.source_dir, f)
-            for f in os.listdir(self.source_dir)
-            if os.path.isfile(os.path.join(self.source_dir, f))
-        ]
-        if not files:
-            if log_callback:
-                log_callback("Không có file trong thư mục nguồn.")
+        self.output_dir = dst
+        with self.metrics.stage("dir_scan"):
+            entries = self.source_index.scan(self.source_dir, lambda msg: publish(LogLine(msg)))
+        if not entries:
+            publish(LogLine("Không có file trong thư mục nguồn."))
+            publish(Finished(0, 0))
             return 0, 0
 
-        file_map = {
-            normalize_text(os.path.splitext(os.path.basename(f))[0]): f
-            for f in files
-            if not self.extensions or os.path.splitext(f)[1].lower() in self.extensions
-        }
+        if self.extensions and self.match_mode != "hash":
+            entries = [e for e in entries if os.path.splitext(e[0])[1].lower() in self.extensions]
+        sizes = {path: size for path, size, _mtime, _norm in entries}
+        # Ở chế độ hash/zip, thời gian đọc checksum được tính vào stage "matching"
+        matching_start = time.perf_counter()
+        if self.match_mode == "hash":
+            find = self._hash_matcher(entries, publish)
+        elif self.match_mode == "zip":
+            find = self._zip_matcher(entries, publish)
+        else:
+            find = self._name_matcher(entries)
 
         total = len(self.games)
         results = []
-
-        for i, game in enumerate(self.games):
-            game_name_norm = normalize_text(game["name"])
-            match = file_map.get(game_name_norm)
-            if not match:
-                results.append(f"[MISS] {game['name']}")
+        publish(Started(total))
+
+        def report(result):
+            # Chỉ gọi từ luồng điều phối -> tiến độ luôn tăng dần, không chen lẫn giữa các worker
+            results.append(result)
+            for prefix, counter in (("[OK]", "files_ok"), ("[SKIP]", "files_skipped"),
+                                    ("[MISS]", "files_missed"), ("[ERR", "files_failed")):
+                if result.startswith(prefix):
+                    self.metrics.count(counter)
+                    break
+            publish(Progress(len(results), total))
+            publish(ItemResult(result))
+
+        # Ghép tên trước (nhanh), gom các file cần copy
+        self.worker_stats = {}
+        jobs = []
+        scheduled = set()
+        for game in self.games:
+            found = find(game)
+            if not found:
+                report(f"[MISS] {game.name}")
+                continue
+            match, dest_name = found
+            if dest_name in scheduled:
+                report(f"[SKIP] {dest_name} (trùng)")
             else:
-                dst_path = os.path.join(dst, os.path.basename(match))
-                if os.path.exists(dst_path):
-                    results.append(f"[SKIP] {os.path.basename(dst_path)}")
-                else:
-                    try:
-                        shutil.copy2(match, dst_path)
-                        with self.lock:
-                            self.copied_count += 1
-                        results.append(f"[OK] {os.path.basename(match)}")
-                    except Exception as e:
-                        results.append(f"[ERR] {os.path.basename(match)}: {e}")
-
-            if progress_callback:
-                progress_callback(i + 1, total)
-            if log_callback:
-                log_callback(results[-1])
+                scheduled.add(dest_name)
+                jobs.append((sizes[match], match, os.path.join(dst, dest_name)))
+        self.metrics.add_time("matching", time.perf_counter() - matching_start)
+
+        # File lớn chạy trước để vài file lớn không kéo dài đuôi của cả lượt copy
+        jobs.sort(key=lambda job: job[0], reverse=True)
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="copy") as exe:
+            futures = [exe.submit(self.copy_one, match, dst_path, size) for size, match, dst_path in jobs]
+            for future in as_completed(futures):
+                try:
+                    report(future.result())
+                except Exception as e:
+                    report(f"[ERR FUT] {e}")
+
+        for name, (count, nbytes, seconds) in sorted(self.worker_stats.items()):
+            speed = nbytes / seconds / (1024 * 1024) if seconds > 0 else 0.0
+            publish(LogLine(f"[STAT] {name}: {count} file, {nbytes / (1024 * 1024):.1f} MB, {speed:.1f} MB/s"))
 
         success_count = sum(1 for r in results if r.startswith("[OK]"))
+        publish(Finished(success_count, total))
         return success_count, total
 
+    @staticmethod
+    def _dat_name(name, fallback):
+        """Tên file an toàn từ DAT: bỏ phần thư mục của tên <rom>, rỗng thì dùng `fallback`."""
+        name = os.path.basename(name.replace("\\", "/"))
+        return name if name not in ("", ".", "..") else fallback
+
+    def _name_matcher(self, entries):
+        """Trả về find(game) -> (path, tên đích) hoặc None; tên đích giữ nguyên tên file nguồn."""
+        file_map = {norm: path for path, _size, _mtime, norm in entries}
+
+        def find(game):
+            path = file_map.get(normalize_text(game.name))
+            return (path, os.path.basename(path)) if path else None
+        return find
+
+    def _hash_matcher(self, entries, publish):
+        """Ghép theo checksum của <rom>: ưu tiên SHA1, không có thì dùng CRC32 + size."""
+        hashes = self.hash_db.hash_entries(entries, self.workers, lambda msg: publish(LogLine(msg)))
+        by_sha1, by_crc = {}, {}
+        for path, _size, _mtime, _norm in entries:
+            if path in hashes:
+                crc, sha1, size = hashes[path]
+                by_sha1.setdefault(sha1, path)
+                by_crc.setdefault((crc, size), path)
+
+        def find(game):
+            for name, crc, sha1, size in game.roms:
+                match = by_sha1.get(sha1) if sha1 else by_crc.get((crc, size))
+                if match:
+                    return match, self._dat_name(name, game.name + os.path.splitext(match)[1])
+            return None
+        return find
+
+    def _zip_matcher(self, entries, publish):
+        """Ghép archive theo CRC32 + size của file bên trong với <rom crc size>: archive phải chứa đủ mọi rom."""
+        members = self.hash_db.zip_entries(entries, self.workers, lambda msg: publish(LogLine(msg)))
+        by_member = {}
+        for path, keys in members.items():
+            for key in keys:
+                by_member.setdefault(key, []).append(path)
+
+        def find(game):
+            wanted = {(crc, size) for _name, crc, _sha1, size in game.roms if crc}
+            if not wanted:
+                return None
+            first = next(iter(wanted))
+            for path in by_member.get(first, ()):
+                if wanted.issubset(members[path]):
+                    return path, self._dat_name(game.name + os.path.splitext(path)[1], os.path.basename(path))
+            return None
+        return find
+
+    def copy_one(self, match, dst_path, size):
+        if os.path.exists(dst_path):
+            return f"[SKIP] {os.path.basename(dst_path)}"
+        start = time.perf_counter()
+        try:
+            used = transfer_file(match, dst_path, self.transfer_mode)
+        except Exception as e:
+            return f"[ERR] {os.path.basename(match)}: {e}"
+        elapsed = time.perf_counter() - start
+        self.metrics.add_time("copy", elapsed)
+        self.metrics.count("bytes", size)
+        with self.lock:
+            self.copied_count += 1
+            stats = self.worker_stats.setdefault(threading.current_thread().name, [0, 0, 0.0])
+            stats[0] += 1
+            stats[1] += size
+            stats[2] += elapsed
+        src_name, dst_name = os.path.basename(match), os.path.basename(dst_path)
+        label = src_name if src_name == dst_name else f"{src_name} -> {dst_name}"
+        return f"[OK] {label}" + (f" ({used})" if used != "copy" else "")
+
+# -----------------------
+# Sự kiện từ luồng nền gửi về luồng Tk
+# -----------------------
+XmlListLoaded = namedtuple("XmlListLoaded", "files")
+
 # -----------------------
 # UI
 # -----------------------
@@ -126,7 +370,7 @@ class CopyParentApp:
     def __init__(self, root):
         self.root = root
         self.root.title("Copy no-intro Parent/Clone Games")
-        self.root.geometry("500x650")
+        self.root.geometry("500x780")
         self.root.minsize(400, 600)
 
         self.source_dir = StringVar()
@@ -134,6 +378,9 @@ class CopyParentApp:
         self.extensions = StringVar(value=".zip,.7z,.rar")
         self.skip_keywords = StringVar(value="bios,in-1,demo")
         self.include_clones = tk.BooleanVar(value=False)
+        self.copy_workers = tk.IntVar(value=4)
+        self.transfer_mode = StringVar(value="copy")
+        self.match_mode = StringVar(value="name")
 
         self.xml_list = []
         self.filtered_xml = []
@@ -146,7 +393,13 @@ class CopyParentApp:
         self.progress = None
         self.progress_label = None
 
+        self.metrics = RunMetrics("copy")
+
         self.build_ui()
+        self.ui = UiChannel(self.root, self.txt_log, self._draw_progress,
+                            handlers={Started: self._on_copy_started, Finished: self._on_copy_finished,
+                                      XmlListLoaded: self._on_xml_list_loaded})
+        self.ui.start()
         self.threaded_fetch_xml_list()
 
     def build_ui(self):
@@ -184,7 +437,7 @@ class CopyParentApp:
         Entry(mid_frame, textvariable=self.dest_dir).grid(row=1, column=1, sticky="we", padx=4)
         Button(mid_frame, text="Chọn...", command=self.choose_dest, width=8).grid(row=1, column=2, padx=4)
         
-        Label(mid_frame, text="Phần mở rộng:").grid(row=2, column=0, sticky="w", pady=4)
+        Label(mid_frame, text="Phần mở rộng (bỏ qua khi ghép hash):").grid(row=2, column=0, sticky="w", pady=4)
         Entry(mid_frame, textvariable=self.extensions).grid(row=2, column=1, sticky="we", padx=4)
 
         Label(mid_frame, text="Từ khóa bỏ qua:").grid(row=3, column=0, sticky="w", pady=4)
@@ -194,15 +447,28 @@ class CopyParentApp:
             row=4, column=0, columnspan=3, sticky="w", pady=4
         )
 
+        Label(mid_frame, text="Số luồng copy:").grid(row=5, column=0, sticky="w", pady=4)
+        ttk.Spinbox(mid_frame, from_=1, to=32, textvariable=self.copy_workers, width=6).grid(row=5, column=1, sticky="w", padx=4)
+
+        Label(mid_frame, text="Chế độ copy:").grid(row=6, column=0, sticky="w", pady=4)
+        ttk.Combobox(mid_frame, textvariable=self.transfer_mode, values=TRANSFER_MODES,
+                     state="readonly", width=12).grid(row=6, column=1, sticky="w", padx=4)
+
+        Label(mid_frame, text="Ghép theo:").grid(row=7, column=0, sticky="w", pady=4)
+        ttk.Combobox(mid_frame, textvariable=self.match_mode, values=MATCH_MODES,
+                     state="readonly", width=12).grid(row=7, column=1, sticky="w", padx=4)
+
         progress_frame = Frame(mid_frame)
-        progress_frame.grid(row=5, column=0, columnspan=3, sticky="we", pady=8)
+        progress_frame.grid(row=8, column=0, columnspan=3, sticky="we", pady=8)
         self.progress_label = Label(progress_frame, text="Sẵn sàng")
         self.progress_label.pack(side="top", fill="x")
         self.progress = ttk.Progressbar(progress_frame, mode="determinate")
         self.progress.pack(side="top", fill="x")
+        self.stats_label = Label(progress_frame, text="", font=("Segoe UI", 8), justify="left", anchor="w")
+        self.stats_label.pack(side="top", fill="x")
 
         Button(mid_frame, text="Copy Games", command=self.threaded_copy, 
-               bg="#4CAF50", fg="white", width=15).grid(row=6, column=1, pady=8)
+               bg="#4CAF50", fg="white", width=15).grid(row=9, column=1, pady=8)
 
         # Bottom
         bot_frame = Frame(main_frame, bd=2, relief="groove", padx=8, pady=6)
@@ -223,12 +489,17 @@ class CopyParentApp:
     # UI helpers
     # -----------------------
     def log(self, msg):
-        self.txt_log.insert(END, msg + "\n")
-        self.txt_log.see(END)
+        # An toàn khi gọi từ luồng nền: chỉ đẩy vào hàng đợi, luồng Tk sẽ chèn theo lô
+        self.ui.log(msg)
 
-    def update_progress(self, current, total):
+    def _on_copy_started(self, event):
+        self.progress["value"] = 0
+        self.progress_label.config(text=f"Đang xử lý: 0/{event.total}")
+
+    def _draw_progress(self, current, total):
         self.progress["value"] = (current / total) * 100
         self.progress_label.config(text=f"Đang xử lý: {current}/{total}")
+        self.stats_label.config(text=self.metrics.format_panel())
         if current == total:
             self.root.after(1000, lambda: self.progress_label.config(text="Hoàn thành"))
 
@@ -249,15 +520,21 @@ class CopyParentApp:
     def fetch_xml_list(self):
         self.log("Đang tải danh sách XML từ GitHub...")
         try:
-            data = fetch_json(API_URL)
-            self.xml_list = sorted([f for f in data if f["name"].endswith(".xml")], 
+            with self.metrics.stage("github_listing"):
+                data = fetch_json(API_URL, self.metrics)
+            xml_list = sorted([f for f in data if f["name"].endswith(".xml")],
                                    key=lambda x: x["name"].lower())
-            self.filtered_xml = self.xml_list[:]
-            self.root.after(0, self.update_xml_listbox)
-            self.log(f"Đã lấy {len(self.xml_list)} file XML.")
+            # Danh sách + Listbox chỉ được đụng tới trên luồng Tk
+            self.ui.publish(XmlListLoaded(xml_list))
+            self.log(f"Đã lấy {len(xml_list)} file XML.")
         except Exception as e:
             self.log(f"Lỗi tải danh sách XML: {e}")
 
+    def _on_xml_list_loaded(self, event):
+        self.xml_list = event.files
+        self.filtered_xml = self.xml_list[:]
+        self.update_xml_listbox()
+
     def update_xml_listbox(self):
         self.lb_xml.delete(0, END)
         for f in self.filtered_xml:
@@ -275,7 +552,7 @@ class CopyParentApp:
         self.log(f"Lọc '{kw}': còn {len(self.filtered_xml)} file.")
         if len(self.filtered_xml) == 1:
             self.lb_xml.selection_set(0)
-            threading.Thread(target=self.parse_xml, args=(self.filtered_xml[0],), daemon=True).start()
+            self.threaded_parse_xml(self.filtered_xml[0])
 
     def reset_xml_list(self):
         self.filtered_xml = self.xml_list[:]
@@ -283,21 +560,35 @@ class CopyParentApp:
 
     def on_xml_select(self, event):
         if sel := self.lb_xml.curselection():
-            threading.Thread(target=self.parse_xml, args=(self.filtered_xml[sel[0]],), daemon=True).start()
+            self.threaded_parse_xml(self.filtered_xml[sel[0]])
 
-    def parse_xml(self, f):
+    def threaded_parse_xml(self, f):
+        # Đọc tùy chọn lọc trên luồng Tk, luồng nền chỉ nhận giá trị
+        args = (f, self.skip_keywords.get(), self.include_clones.get())
+        threading.Thread(target=self.parse_xml, args=args, daemon=True).start()
+
+    def parse_xml(self, f, skip_keywords, include_clones):
         if not (url := f.get("download_url")):
             self.log(f"Lỗi: download_url không có cho {f.get('name')}")
             return
         self.current_xml_file = f["name"]
         self.log(f"Tải & parse XML: {f['name']} ...")
+        sha, variant = f.get("sha"), f"{int(include_clones)}|{skip_keywords}|named-roms"
+        if sha and (cached := DAT_CACHE.get(sha, variant, Game)) is not None:
+            self.games = cached
+            self.log(f"Parse xong {len(self.games)} game từ {f['name']} (cache).")
+            return
         try:
-            text = fetch_text(url)
-            self.games = parse_xml_games(
-                text,
-                skip_keywords=self.skip_keywords.get(),
-                include_clones=self.include_clones.get()
-            )
+            with self.metrics.stage("xml_download"):
+                xml_file = open_url(url, metrics=self.metrics)
+            with xml_file, self.metrics.stage("xml_parse"):
+                self.games = parse_xml_games(
+                    xml_file,
+                    skip_keywords=skip_keywords,
+                    include_clones=include_clones
+                )
+            if sha and self.games:
+                DAT_CACHE.put(sha, variant, self.games, Game)
             self.log(f"Parse xong {len(self.games)} game từ {f['name']}.")
         except Exception as e:
             self.log(f"Lỗi parse XML: {e}")
@@ -306,9 +597,7 @@ class CopyParentApp:
     # Copy files
     # -----------------------
     def threaded_copy(self):
-        threading.Thread(target=self.copy_files, daemon=True).start()
-
-    def copy_files(self):
+        # Kiểm tra đầu vào trên luồng Tk; chỉ phần copy chạy ở luồng nền
         if not self.games:
             messagebox.showerror("Lỗi", "Chưa chọn file XML hoặc chưa parse xong.")
             return
@@ -336,12 +625,31 @@ class CopyParentApp:
             extensions = set(ext.lower() for ext in ext_text.split(",") if ext.strip())
             extensions = {ext if ext.startswith(".") else f".{ext}" for ext in extensions}
 
-        processor = CopyOnlyProcessor(src, dst_root, self.current_xml_file, self.games, extensions)
-        success, total = processor.process(
-            progress_callback=self.update_progress,
-            log_callback=self.log
-        )
-        self.log(f"Xong! Đã copy {success}/{total} file vào thư mục {os.path.splitext(self.current_xml_file)[0]}.")
+        match_mode = self.match_mode.get()
+        if match_mode == "hash" and extensions:
+            self.log("Ghép theo hash: bỏ qua bộ lọc phần mở rộng, hash mọi file trong thư mục nguồn.")
+
+        self.metrics.start_run()
+        processor = CopyOnlyProcessor(src, dst_root, self.current_xml_file, self.games, extensions,
+                                      workers=self.copy_workers.get(), transfer_mode=self.transfer_mode.get(),
+                                      match_mode=match_mode, metrics=self.metrics)
+        threading.Thread(target=self.copy_files, args=(processor,), daemon=True).start()
+
+    def copy_files(self, processor):
+        try:
+            processor.process(events=self.ui)
+        except Exception as e:
+            self.log(f"Lỗi copy: {e}")
+            return
+        try:
+            paths = processor.metrics.export(processor.output_dir, "copy")
+            self.log(f"[METRICS] Đã ghi {', '.join(os.path.basename(p) for p in paths)}")
+        except OSError as e:
+            self.log(f"[METRICS] Không ghi được số đo: {e}")
+
+    def _on_copy_finished(self, event):
+        folder = os.path.splitext(os.path.basename(self.current_xml_file or ""))[0]
+        self.log(f"Xong! Đã copy {event.success}/{event.total} file vào thư mục {folder}.")
 
 def main():
     root = Tk()
@@ -1,46 +1,32 @@
-import os, sys, re, shutil, threading, urllib.request, json, xml.etree.ElementTree as ET
+import os, sys, threading, time, xml.etree.ElementTree as ET
 from tkinter import Tk, Frame, Label, Button, Listbox, Scrollbar, Text, END, filedialog, StringVar, Entry, messagebox, ttk
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import namedtuple
+from romtools_common import (DAT_CACHE, SOURCE_INDEX, TRANSFER_MODES, RunMetrics, fetch_json, iter_xml_elements,
+                             normalize_text, open_url, transfer_file)
+from romtools_ui import Finished, ItemResult, LogLine, Progress, Started, UiChannel
 
 API_URL = "https://api.github.com/repos/mamedev/mame/contents/hash"
 
 # -----------------------
 # Helpers
 # -----------------------
-def fetch_url(url, timeout=30, retries=3):
-    for i in range(retries):
-        try:
-            req = urllib.request.Request(url, headers={"User-Agent": "python-urllib/3"})
-            with urllib.request.urlopen(req, timeout=timeout) as resp:
-                return resp.read()
-        except Exception as e:
-            if i == retries - 1:
-                raise e
-            threading.Event().wait(1)  # Wait before retry
+class Software:
+    """Một <software> của DAT. `__slots__` + tên interned: hàng triệu bản ghi không kèm dict riêng."""
+    __slots__ = ("name", "description")
 
-def fetch_json(url):
-    return json.loads(fetch_url(url).decode("utf-8"))
+    def __init__(self, name, description):
+        self.name = sys.intern(name)
+        self.description = description
 
-def fetch_text(url):
-    data = fetch_url(url)
-    try:
-        return data.decode("utf-8")
-    except UnicodeDecodeError:
-        return data.decode("latin-1")
-
-def normalize_text(s):
-    if not s:
-        return ""
-    s = s.lower()
-    s = re.sub(r"[^a-z0-9\u00C0-\u024f\s]", " ", s)
-    return re.sub(r"\s+", " ", s).strip()
-
-def parse_xml_softwares(xml_text):
+def iter_softwares(xml_source):
+    for sw in iter_xml_elements(xml_source, "software"):
+        yield Software(sw.get("name", "").strip(), (sw.findtext("description") or "").strip())
+
+def parse_xml_softwares(xml_source):
+    """Danh sách software từ XML (str, bytes hoặc file object đọc theo luồng)."""
     try:
-        root = ET.fromstring(xml_text)
-        return [{"name": sw.get("name", "").strip(),
-                 "description": (sw.findtext("description") or "").strip()}
-                for sw in root.iter("software")]
+        return list(iter_softwares(xml_source))
     except ET.ParseError:
         return []
 
@@ -56,72 +42,139 @@ def find_match_fast(desc, file_map):
             return path
     return None
 
+class MatchIndex:
+    """Index n-gram trên tên file đã chuẩn hóa.
+
+    Trả về đúng kết quả như find_match_fast (file đầu tiên theo thứ tự của
+    file_map có chứa mô tả), nhưng chỉ kiểm tra các ứng viên có chung n-gram
+    hiếm nhất thay vì quét toàn bộ file_map.
+    """
+    GRAM = 3
+
+    def __init__(self, file_map):
+        self.names = list(file_map.keys())
+        self.paths = list(file_map.values())
+        self.postings = {}
+        n = self.GRAM
+        for idx, name in enumerate(self.names):
+            for gram in {name[j:j + n] for j in range(len(name) - n + 1)}:
+                self.postings.setdefault(gram, []).append(idx)
+
+    def find(self, desc):
+        desc_norm = normalize_text(desc)
+        n = self.GRAM
+        if len(desc_norm) < n:
+            # Chuỗi quá ngắn để tra n-gram -> quét tuần tự như cũ
+            for name, path in zip(self.names, self.paths):
+                if desc_norm in name:
+                    return path
+            return None
+
+        lists = []
+        for gram in {desc_norm[j:j + n] for j in range(len(desc_norm) - n + 1)}:
+            ids = self.postings.get(gram)
+            if not ids:
+                return None
+            lists.append(ids)
+        # Posting list đã được sắp theo thứ tự file_map nên ứng viên khớp đầu tiên là kết quả
+        for idx in min(lists, key=len):
+            if desc_norm in self.names[idx]:
+                return self.paths[idx]
+        return None
+
 # -----------------------
 # Core Logic (tách riêng để dễ testing)
 # -----------------------
 class CopyRenameProcessor:
-    def __init__(self, source_dir, dest_dir, xml_file, items, extensions=None):
+    def __init__(self, source_dir, dest_dir, xml_file, items, extensions=None, transfer_mode="copy", source_index=None,
+                 metrics=None):
         self.source_dir = source_dir
         self.dest_dir = dest_dir
         self.xml_file = xml_file
         self.items = items
         self.extensions = extensions
+        self.transfer_mode = transfer_mode
+        self.source_index = source_index or SOURCE_INDEX
+        self.metrics = metrics or RunMetrics("copy")
+        self.output_dir = None
         self.copied_count = 0
         self.lock = threading.Lock()
         
-    def process(self, progress_callback=None, log_callback=None):
+    def process(self, events=None):
+        """Chạy copy + đổi tên; tiến độ/kết quả được publish lên `events` (UiChannel hoặc tương tự)."""
+        publish = events.publish if events else (lambda event: None)
         dst = os.path.join(self.dest_dir, os.path.splitext(os.path.basename(self.xml_file))[0]) if self.xml_file else self.dest_dir
         os.makedirs(dst, exist_ok=True)
 
-        files = [os.path.join(self.source_dir, f) for f in os.listdir(self.source_dir) if os.path.isfile(os.path.join(self.source_dir, f))]
-        if not files:
-            if log_callback:
-                log_callback("Không có file trong thư mục nguồn.")
+        self.output_dir = dst
+        with self.metrics.stage("dir_scan"):
+            entries = self.source_index.scan(self.source_dir, lambda msg: publish(LogLine(msg)))
+        if not entries:
+            publish(LogLine("Không có file trong thư mục nguồn."))
+            publish(Finished(0, 0))
             return 0, 0
 
-        file_map = build_normalized_file_map(files, self.extensions)
-        if log_callback:
-            log_callback(f"Bắt đầu copy đa luồng vào thư mục: {dst}")
+        with self.metrics.stage("matching"):
+            file_map = {norm: path for path, _size, _mtime, norm in entries
+                        if not self.extensions or os.path.splitext(path)[1].lower() in self.extensions}
+            match_index = MatchIndex(file_map)
+        publish(LogLine(f"Bắt đầu copy đa luồng vào thư mục: {dst}"))
 
         results = []
         total = len(self.items)
+        publish(Started(total))
         
         with ThreadPoolExecutor(max_workers=min(os.cpu_count() or 4, 8)) as exe:
-            futures = {exe.submit(self.process_item, item, dst, file_map): i for i, item in enumerate(self.items)}
+            futures = {exe.submit(self.process_item, item, dst, match_index): i for i, item in enumerate(self.items)}
             
             for i, future in enumerate(as_completed(futures)):
                 try:
                     result = future.result()
-                    results.append(result)
                 except Exception as e:
-                    results.append(f"[ERR FUT] {e}")
-                
-                if progress_callback:
-                    progress_callback(i + 1, total)
-                
-                if log_callback:
-                    log_callback(result)
+                    result = f"[ERR FUT] {e}"
+                results.append(result)
+                self._count_result(result)
+                publish(Progress(i + 1, total))
+                publish(ItemResult(result))
         
         success_count = sum(1 for r in results if r.startswith("[OK]"))
+        publish(Finished(success_count, total))
         return success_count, total
 
-    def process_item(self, item, dst, file_map):
-        match = find_match_fast(item.get("description"), file_map)
+    def _count_result(self, result):
+        for prefix, counter in (("[OK]", "files_ok"), ("[SKIP]", "files_skipped"),
+                                ("[MISS]", "files_missed"), ("[ERR", "files_failed")):
+            if result.startswith(prefix):
+                self.metrics.count(counter)
+                return
+
+    def process_item(self, item, dst, match_index):
+        with self.metrics.stage("matching"):
+            match = match_index.find(item.description)
         if not match:
-            return f"[MISS] {item.get('name')} - {item.get('description')}"
+            return f"[MISS] {item.name} - {item.description}"
             
-        dst_path = os.path.join(dst, item["name"] + os.path.splitext(match)[1])
+        dst_path = os.path.join(dst, item.name + os.path.splitext(match)[1])
         if os.path.exists(dst_path):
             return f"[SKIP] {os.path.basename(dst_path)} (đã có)"
             
         try:
-            shutil.copy2(match, dst_path)
+            start = time.perf_counter()
+            used = transfer_file(match, dst_path, self.transfer_mode)
+            self.metrics.add_time("copy", time.perf_counter() - start)
+            self.metrics.count("bytes", os.path.getsize(dst_path))
             with self.lock:
                 self.copied_count += 1
-            return f"[OK] {os.path.basename(match)} -> {os.path.basename(dst_path)}"
+            suffix = f" ({used})" if used != "copy" else ""
+            return f"[OK] {os.path.basename(match)} -> {os.path.basename(dst_path)}{suffix}"
         except Exception as e:
             return f"[ERR] {match}: {e}"
 
+# -----------------------
+# Sự kiện từ luồng nền gửi về luồng Tk
+# -----------------------
+XmlListLoaded = namedtuple("XmlListLoaded", "files")
+
 # -----------------------
 # UI
 # -----------------------
@@ -129,12 +182,13 @@ class CopyRenameApp:
     def __init__(self, root):
         self.root = root
         self.root.title("Copy & Rename từ MAME hash XML")
-        self.root.geometry("600x600")
+        self.root.geometry("600x640")
         self.root.minsize(500, 500)
 
         self.source_dir = StringVar()
         self.dest_dir = StringVar(value=os.path.dirname(os.path.abspath(sys.argv[0])))
         self.extensions = StringVar(value=".zip,.7z,.rar")  # Filter phần mở rộng
+        self.transfer_mode = StringVar(value="copy")
 
         self.xml_list = []
         self.filtered_xml = []
@@ -147,7 +201,13 @@ class CopyRenameApp:
         self.progress = None
         self.progress_label = None
 
+        self.metrics = RunMetrics("copy")
+
         self.build_ui()
+        self.ui = UiChannel(self.root, self.txt_log, self._draw_progress,
+                            handlers={Started: self._on_copy_started, Finished: self._on_copy_finished,
+                                      XmlListLoaded: self._on_xml_list_loaded})
+        self.ui.start()
         self.threaded_fetch_xml_list()
 
     def build_ui(self):
@@ -190,16 +250,22 @@ class CopyRenameApp:
         Entry(mid_frame, textvariable=self.extensions).grid(row=2, column=1, sticky="we", padx=4)
         Label(mid_frame, text="(cách nhau bằng dấu phẩy)").grid(row=2, column=2, sticky="w", padx=4)
 
+        Label(mid_frame, text="Chế độ copy:").grid(row=3, column=0, sticky="w", pady=4)
+        ttk.Combobox(mid_frame, textvariable=self.transfer_mode, values=TRANSFER_MODES,
+                     state="readonly", width=12).grid(row=3, column=1, sticky="w", padx=4)
+
         # Progress bar
         progress_frame = Frame(mid_frame)
-        progress_frame.grid(row=3, column=0, columnspan=3, sticky="we", pady=8)
+        progress_frame.grid(row=4, column=0, columnspan=3, sticky="we", pady=8)
         self.progress_label = Label(progress_frame, text="Sẵn sàng")
         self.progress_label.pack(side="top", fill="x")
         self.progress = ttk.Progressbar(progress_frame, mode="determinate")
         self.progress.pack(side="top", fill="x")
+        self.stats_label = Label(progress_frame, text="", font=("Segoe UI", 8), justify="left", anchor="w")
+        self.stats_label.pack(side="top", fill="x")
 
         Button(mid_frame, text="Copy + Rename", command=self.threaded_copy, 
-               bg="#4CAF50", fg="white", width=15).grid(row=4, column=1, pady=8)
+               bg="#4CAF50", fg="white", width=15).grid(row=5, column=1, pady=8)
 
         # === Bottom frame: logs ===
         bot_frame = Frame(main_frame, bd=2, relief="groove", padx=8, pady=6)
@@ -217,12 +283,17 @@ class CopyRenameApp:
         self.search_var.trace_add("write", self._on_search_var_changed)
 
     def log(self, msg):
-        self.txt_log.insert(END, msg + "\n")
-        self.txt_log.see(END)
+        # An toàn khi gọi từ luồng nền: chỉ đẩy vào hàng đợi, luồng Tk sẽ chèn theo lô
+        self.ui.log(msg)
+
+    def _on_copy_started(self, event):
+        self.progress["value"] = 0
+        self.progress_label.config(text=f"Đang xử lý: 0/{event.total}")
 
-    def update_progress(self, current, total):
+    def _draw_progress(self, current, total):
         self.progress["value"] = (current / total) * 100
         self.progress_label.config(text=f"Đang xử lý: {current}/{total}")
+        self.stats_label.config(text=self.metrics.format_panel())
         if current == total:
             self.root.after(1000, lambda: self.progress_label.config(text="Hoàn thành"))
 
@@ -240,15 +311,21 @@ class CopyRenameApp:
     def fetch_xml_list(self):
         self.log("Đang tải danh sách XML từ GitHub...")
         try:
-            data = fetch_json(API_URL)
-            self.xml_list = sorted([f for f in data if f["name"].endswith(".xml")], 
+            with self.metrics.stage("github_listing"):
+                data = fetch_json(API_URL, self.metrics)
+            xml_list = sorted([f for f in data if f["name"].endswith(".xml")],
                                   key=lambda x: x["name"].lower())
-            self.filtered_xml = self.xml_list[:]
-            self.root.after(0, self.update_xml_listbox)
-            self.log(f"Đã lấy {len(self.xml_list)} file XML.")
+            # Danh sách + Listbox chỉ được đụng tới trên luồng Tk
+            self.ui.publish(XmlListLoaded(xml_list))
+            self.log(f"Đã lấy {len(xml_list)} file XML.")
         except Exception as e:
             self.log(f"Lỗi tải danh sách XML: {e}")
 
+    def _on_xml_list_loaded(self, event):
+        self.xml_list = event.files
+        self.filtered_xml = self.xml_list[:]
+        self.update_xml_listbox()
+
     def update_xml_listbox(self):
         self.lb_xml.delete(0, END)
         for f in self.filtered_xml:
@@ -283,17 +360,23 @@ class CopyRenameApp:
             
         self.current_xml_file = f["name"]
         self.log(f"Tải & parse XML: {f['name']} ...")
+        if (sha := f.get("sha")) and (cached := DAT_CACHE.get(sha, "", Software)) is not None:
+            self.items = cached
+            self.log(f"Parse xong {len(self.items)} mục từ {f['name']} (cache).")
+            return
         try:
-            text = fetch_text(url)
-            self.items = parse_xml_softwares(text)
+            with self.metrics.stage("xml_download"):
+                xml_file = open_url(url, metrics=self.metrics)
+            with xml_file, self.metrics.stage("xml_parse"):
+                self.items = parse_xml_softwares(xml_file)
+            if sha and self.items:
+                DAT_CACHE.put(sha, "", self.items, Software)
             self.log(f"Parse xong {len(self.items)} mục từ {f['name']}.")
         except Exception as e:
             self.log(f"Lỗi parse XML: {e}")
 
     def threaded_copy(self):
-        threading.Thread(target=self.copy_files, daemon=True).start()
-
-    def copy_files(self):
+        # Kiểm tra đầu vào trên luồng Tk; chỉ phần copy chạy ở luồng nền
         if not self.items:
             messagebox.showerror("Lỗi", "Chưa chọn file XML hoặc chưa parse xong.")
             return
@@ -310,13 +393,25 @@ class CopyRenameApp:
             extensions = set(ext.lower() for ext in ext_text.split(",") if ext.strip())
             extensions = {ext if ext.startswith(".") else f".{ext}" for ext in extensions}
 
-        processor = CopyRenameProcessor(src, dst_root, self.current_xml_file, self.items, extensions)
-        success, total = processor.process(
-            progress_callback=self.update_progress,
-            log_callback=self.log
-        )
-        
-        self.log(f"Xong! Đã copy {success}/{total} file.")
+        self.metrics.start_run()
+        processor = CopyRenameProcessor(src, dst_root, self.current_xml_file, self.items, extensions,
+                                        transfer_mode=self.transfer_mode.get(), metrics=self.metrics)
+        threading.Thread(target=self.copy_files, args=(processor,), daemon=True).start()
+
+    def copy_files(self, processor):
+        try:
+            processor.process(events=self.ui)
+        except Exception as e:
+            self.log(f"Lỗi copy: {e}")
+            return
+        try:
+            paths = processor.metrics.export(processor.output_dir, "copy")
+            self.log(f"[METRICS] Đã ghi {', '.join(os.path.basename(p) for p in paths)}")
+        except OSError as e:
+            self.log(f"[METRICS] Không ghi được số đo: {e}")
+
+    def _on_copy_finished(self, event):
+        self.log(f"Xong! Đã copy {event.success}/{event.total} file.")
 
 def main():
     root = Tk()
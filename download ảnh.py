@@ -1,31 +1,974 @@
 import urllib.request
+import urllib.error
+import urllib.parse
+import http.client
+import asyncio
+import ssl
+import io
+import base64
 import os
+import sys
+import re
+import json
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
-from xml.etree import ElementTree
-import io
 import concurrent.futures
+import multiprocessing
 import threading
+import queue
+import sqlite3
 import time
 from datetime import timedelta
+from collections import namedtuple
+from contextlib import contextmanager, asynccontextmanager
+from romtools_common import (CACHE_DIR, PERMANENT, THROTTLED, HttpCache, RetryPolicy, RunMetrics, classify_error,
+                             fetch_url, iter_xml_elements, open_url, validate_png)
+from romtools_ui import Finished, ItemResult, Started, UiChannel
+
+
+# Proxy HTTP(S) lấy từ biến môi trường như opener của urllib: host, port và header gửi kèm cho proxy
+Proxy = namedtuple("Proxy", "host port headers")
+
+def proxy_for(scheme, host, proxies):
+    """Proxy dùng cho `scheme`://`host` theo `proxies` (urllib.request.getproxies()), None nếu đi thẳng / no_proxy."""
+    proxy_url = proxies.get(scheme)
+    if not proxy_url or urllib.request.proxy_bypass(host):
+        return None
+    if "://" not in proxy_url:
+        proxy_url = "http://" + proxy_url
+    parts = urllib.parse.urlsplit(proxy_url)
+    headers = {}
+    if parts.username is not None:
+        cred = f"{urllib.parse.unquote(parts.username)}:{urllib.parse.unquote(parts.password or '')}"
+        headers["Proxy-Authorization"] = "Basic " + base64.b64encode(cred.encode("utf-8")).decode("ascii")
+    return Proxy(parts.hostname, parts.port or 80, headers)
+
+def request_target(parts, proxy):
+    """Đích của dòng request: đường dẫn, hoặc URL đầy đủ khi gửi HTTP thường qua proxy."""
+    if proxy and parts.scheme.lower() == "http":
+        return urllib.parse.urlunsplit((parts.scheme, parts.netloc, parts.path or "/", parts.query, ""))
+    return urllib.parse.urlunsplit(("", "", parts.path or "/", parts.query, ""))
+
+def open_tunnel(proxy, host, port, timeout):
+    """Socket đã qua CONNECT `host`:`port` của proxy (chưa bắt tay TLS)."""
+    conn = http.client.HTTPConnection(proxy.host, proxy.port, timeout=timeout)
+    conn.set_tunnel(host, port, headers=proxy.headers)
+    try:
+        conn.connect()
+    except BaseException:
+        conn.close()
+        raise
+    sock, conn.sock = conn.sock, None
+    return sock
+
+
+class ConnectionPool:
+    """Pool kết nối HTTP/1.1 keep-alive theo host, dùng chung giữa các luồng tải.
+
+    Mỗi host giữ tối đa `maxsize` kết nối rảnh; kết nối chết (server đóng
+    keep-alive) được mở lại tự động một lần. Tôn trọng HTTP(S)_PROXY / NO_PROXY
+    như urllib (HTTPS đi qua đường hầm CONNECT).
+    """
+    MAX_REDIRECTS = 5
+
+    def __init__(self, maxsize=16, headers=None, proxies=None):
+        self.maxsize = maxsize
+        self.headers = headers or {}
+        self.proxies = urllib.request.getproxies() if proxies is None else proxies
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def resize(self, maxsize):
+        with self._lock:
+            self.maxsize = max(1, maxsize)
+            for conns in self._idle.values():
+                while len(conns) > self.maxsize:
+                    conns.pop(0).close()
+
+    def _acquire(self, key, timeout, proxy=None):
+        with self._lock:
+            conns = self._idle.get(key)
+            if conns:
+                conn = conns.pop()
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+        scheme, host, port = key
+        cls = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+        if proxy is None:
+            return cls(host, port, timeout=timeout), False
+        conn = cls(proxy.host, proxy.port, timeout=timeout)
+        if scheme == "https":
+            conn.set_tunnel(host, port, headers=proxy.headers)
+        return conn, False
+
+    def _release(self, key, conn):
+        with self._lock:
+            conns = self._idle.setdefault(key, [])
+            if len(conns) < self.maxsize:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def _request(self, key, path, headers, timeout, proxy=None):
+        # Kết nối tái sử dụng có thể đã bị server đóng -> thử lại một lần với kết nối mới
+        while True:
+            conn, reused = self._acquire(key, timeout, proxy)
+            try:
+                conn.request("GET", path, headers=headers)
+                return conn, conn.getresponse()
+            except (http.client.RemoteDisconnected, http.client.BadStatusLine,
+                    ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
+                conn.close()
+                if not reused:
+                    raise
+            except Exception:
+                conn.close()
+                raise
+
+    @contextmanager
+    def open(self, url, timeout, headers=None):
+        """GET `url`, trả về http.client.HTTPResponse; kết nối được trả lại pool khi đọc hết body."""
+        for _ in range(self.MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            scheme = parts.scheme.lower()
+            port = parts.port or (443 if scheme == "https" else 80)
+            key = (scheme, parts.hostname, port)
+            proxy = proxy_for(scheme, parts.hostname, self.proxies)
+            req_headers = {**self.headers, **(headers or {})}
+            if proxy and scheme == "http":
+                req_headers.update(proxy.headers)
+            conn, resp = self._request(key, request_target(parts, proxy), req_headers, timeout, proxy)
+
+            if resp.status in (301, 302, 303, 307, 308) and resp.getheader("Location"):
+                resp.read()
+                self._finish(key, conn, resp)
+                url = urllib.parse.urljoin(url, resp.getheader("Location"))
+                continue
+            if resp.status >= 400:
+                resp.read()
+                self._finish(key, conn, resp)
+                raise urllib.error.HTTPError(url, resp.status, resp.reason, resp.headers, None)
+
+            try:
+                yield resp
+            except BaseException:
+                conn.close()
+                raise
+            self._finish(key, conn, resp)
+            return
+        raise urllib.error.URLError(f"Quá nhiều chuyển hướng: {url}")
+
+    def _finish(self, key, conn, resp):
+        if resp.isclosed() and not resp.will_close:
+            self._release(key, conn)
+        else:
+            conn.close()
+
+class AdaptiveLimiter:
+    """Giới hạn số download đồng thời, tự điều chỉnh kiểu AIMD.
+
+    Sau mỗi cửa sổ `WINDOW` giây: bị chặn (429/503) hoặc lỗi nhiều / độ trễ
+    tăng vọt thì giảm theo cấp số nhân; ổn định và đang dùng hết giới hạn thì
+    tăng thêm 1. Mỗi lần đổi gọi on_change(giới hạn mới, lý do).
+    """
+    WINDOW = 2.0
+
+    def __init__(self, initial, minimum=1, maximum=64, on_change=None):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = min(max(initial, self.minimum), self.maximum)
+        self.on_change = on_change
+        self.inflight = 0
+        self._cond = threading.Condition()
+        self._samples = []
+        self._window_start = time.monotonic()
+        self._peak = 0
+        self._base_latency = None
+        self._last_rate = 0.0
+
+    def try_acquire(self):
+        with self._cond:
+            if self.inflight < self.limit:
+                self.inflight += 1
+                self._peak = max(self._peak, self.inflight)
+                return True
+            return False
+
+    def acquire(self, cancel_event=None):
+        with self._cond:
+            while self.inflight >= self.limit:
+                if cancel_event is not None and cancel_event.is_set():
+                    return False
+                self._cond.wait(0.2)
+            self.inflight += 1
+            self._peak = max(self._peak, self.inflight)
+            return True
+
+    def release(self, latency, ok, nbytes=0, throttled=False):
+        change = None
+        with self._cond:
+            self.inflight -= 1
+            self._samples.append((latency, ok, nbytes, throttled))
+            change = self._adjust_locked()
+            self._cond.notify_all()
+        if change and self.on_change:
+            self.on_change(*change)
+
+    def _adjust_locked(self):
+        now = time.monotonic()
+        elapsed = now - self._window_start
+        if elapsed < self.WINDOW or not self._samples:
+            return None
+        samples, peak = self._samples, self._peak
+        self._samples, self._peak, self._window_start = [], self.inflight, now
+
+        latencies = sorted(s[0] for s in samples)
+        p50 = latencies[len(latencies) // 2]
+        errors = sum(1 for s in samples if not s[1])
+        rate = sum(s[2] for s in samples) / elapsed
+        last_rate, self._last_rate = self._last_rate, rate
+        # Độ trễ nền: bám theo mức thấp nhất, cho phép trôi lên chậm nếu mạng đổi
+        self._base_latency = p50 if self._base_latency is None else min(p50, self._base_latency * 1.05)
+
+        new, reason = self.limit, None
+        if any(s[3] for s in samples):
+            new, reason = int(self.limit * 0.5), "server giới hạn tốc độ (429/503)"
+        elif errors / len(samples) > 0.1:
+            new, reason = int(self.limit * 0.7), f"tỉ lệ lỗi {errors}/{len(samples)}"
+        elif p50 > max(self._base_latency * 3, 0.05):
+            new, reason = int(self.limit * 0.8), f"độ trễ p50 {p50:.2f}s (nền {self._base_latency:.2f}s)"
+        elif peak >= self.limit and rate >= last_rate * 0.9:
+            new, reason = self.limit + 1, f"ổn định, {rate / 1024:.0f} KB/s, p50 {p50:.2f}s"
+
+        new = min(max(new, self.minimum), self.maximum)
+        if new == self.limit:
+            return None
+        self.limit = new
+        return new, reason
+
+
+def classify_for_limiter(exc):
+    """(ok, throttled) của một lần tải lỗi: lỗi vĩnh viễn nghĩa là server vẫn khỏe, không tính là lỗi tải."""
+    kind = classify_error(exc)
+    return kind == PERMANENT, kind == THROTTLED
+
+class NegativeCache:
+    """URL ảnh đã xác nhận không tồn tại (404/410), lưu giữa các lần chạy trong SQLite.
+
+    Bản ghi còn hạn (`ttl` giây) được bỏ qua khi lập kế hoạch tải; hết hạn thì được thử lại.
+    Ghi theo lô như DownloadManifest.
+    """
+    FLUSH_EVERY = 200
+
+    def __init__(self, path, ttl=7 * 24 * 3600):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._pending = []
+        self._db = None
+
+    def _conn(self):
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            db.execute("CREATE TABLE IF NOT EXISTS missing (url TEXT PRIMARY KEY, status INTEGER, checked REAL)")
+            self._db = db
+        return self._db
+
+    def load(self):
+        """Tập URL còn trong hạn TTL."""
+        with self._lock:
+            self._flush_locked()
+            rows = self._conn().execute("SELECT url FROM missing WHERE checked >= ?", (time.time() - self.ttl,))
+            return {row[0] for row in rows}
+
+    def add(self, url, status):
+        with self._lock:
+            self._pending.append(("add", url, status))
+            if len(self._pending) >= self.FLUSH_EVERY:
+                self._flush_locked()
+
+    def forget(self, url):
+        with self._lock:
+            self._pending.append(("forget", url, None))
+
+    def _flush_locked(self):
+        if self._pending:
+            now = time.time()
+            db = self._conn()
+            with db:
+                for op, url, status in self._pending:
+                    if op == "add":
+                        db.execute("INSERT OR REPLACE INTO missing VALUES (?, ?, ?)", (url, status, now))
+                    else:
+                        db.execute("DELETE FROM missing WHERE url=?", (url,))
+            self._pending = []
+
+    def flush(self):
+        with self._lock:
+            try:
+                self._flush_locked()
+            except sqlite3.Error:
+                pass
+
+
+class PartialFile:
+    """Ảnh tải dở: `<tên>.part` kèm validator (ETag/Last-Modified) trong `<tên>.part.meta`.
+
+    Lần thử sau gửi `Range` + `If-Range`; server trả 206 thì ghi nối tiếp, trả 200 (file đã đổi hoặc
+    không hỗ trợ Range) thì ghi lại từ đầu. Không có validator thì không giữ phần dở.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.path = filename + ".part"
+        self.meta_path = self.path + ".meta"
+        self._f = None
+        self._total = None
+        self._received = 0
+        self._load()
+
+    def _load(self):
+        self.offset, self.validator = 0, None
+        try:
+            with open(self.meta_path, encoding="utf-8") as f:
+                validator = f.read().strip()
+            size = os.path.getsize(self.path)
+        except OSError:
+            self.discard()
+            return
+        if validator and size > 0:
+            self.offset, self.validator = size, validator
+
+    def discard(self):
+        for path in (self.path, self.meta_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.offset, self.validator = 0, None
+
+    def request_headers(self):
+        if not self.offset:
+            return {}
+        return {"Range": f"bytes={self.offset}-", "If-Range": self.validator}
+
+    def begin(self, resp):
+        """Mở file `.part` theo response: 206 đúng offset -> nối tiếp, còn lại -> ghi từ đầu."""
+        if resp.status == 206 and self.offset:
+            m = re.match(r"bytes (\d+)-\d+/(\d+|\*)", resp.getheader("Content-Range") or "")
+            if not m or int(m.group(1)) != self.offset:
+                self.discard()
+                raise http.client.HTTPException(f"Content-Range không khớp: {resp.getheader('Content-Range')}")
+            self._total = int(m.group(2)) if m.group(2) != "*" else None
+            self._f = open(self.path, "ab")
+        else:
+            etag = resp.getheader("ETag")
+            # If-Range chỉ chấp nhận ETag mạnh (không có tiền tố W/)
+            validator = etag if (etag and not etag.startswith("W/")) else resp.getheader("Last-Modified")
+            length = resp.getheader("Content-Length")
+            self._total = int(length) if (length and length.isdigit()) else None
+            self.discard()
+            if validator:
+                with open(self.meta_path, "w", encoding="utf-8") as f:
+                    f.write(validator)
+            self.validator = validator
+            self._f = open(self.path, "wb")
+        self._received = 0
+
+    def write(self, chunk):
+        self._f.write(chunk)
+        self.offset += len(chunk)
+        self._received += len(chunk)
+
+    def seal(self, fsync):
+        """Kiểm tra đủ dung lượng rồi đóng `.part` (chưa đổi tên), để kiểm tra nội dung trước khi nhận."""
+        if self._total is not None and self.offset != self._total:
+            raise http.client.IncompleteRead(b"", self._total - self.offset)
+        if fsync:
+            self._f.flush()
+            os.fsync(self._f.fileno())
+        self._f.close()
+        self._f = None
+
+    def reject(self, reason):
+        """Nội dung không hợp lệ: bỏ phần đã tải (lần thử sau tải lại từ đầu)."""
+        self.discard()
+        raise InvalidImage(reason)
+
+    def commit(self):
+        """Đổi tên `.part` đã seal() thành file đích; trả về số byte nhận trong lần này."""
+        os.replace(self.path, self.filename)
+        self.discard()
+        return self._received
+
+    def close(self):
+        """Đóng file sau lỗi/hủy: giữ phần đã tải nếu có validator để lần sau tiếp tục."""
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+            if self.validator:
+                self._load()
+            else:
+                self.discard()
+
+
+class InvalidImage(Exception):
+    """Body tải về không phải PNG hợp lệ (trang lỗi HTML, bị cắt, sai CRC)."""
+
+
+class PngValidator:
+    """Chạy validate_png trong ProcessPoolExecutor: phần tính CRC (tốn CPU) không giữ GIL của luồng I/O.
+
+    Pool được tạo lười từ luồng tải nên không dùng fork (fork tiến trình đa luồng có thể treo trên
+    lock đang bị giữ): tiến trình con khởi động bằng forkserver, hoặc spawn nếu nền tảng không có.
+    """
+
+    def __init__(self, workers=None):
+        self.workers = max(1, workers or os.cpu_count() or 2)
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None:
+                method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+                self._pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context(method))
+            return self._pool
+
+    def submit(self, path):
+        return self._executor().submit(validate_png, path)
+
+    def check(self, path):
+        return self.submit(path).result()
+
+    def map(self, paths):
+        """Kiểm tra nhiều file, trả về (path, lý do hoặc None) theo đúng thứ tự."""
+        return zip(paths, self._executor().map(validate_png, paths, chunksize=32))
+
+    def close(self, cancel=False):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=True, cancel_futures=cancel)
+                self._pool = None
+
+
+class DownloadManifest:
+    """Danh sách URL đã tải xong của một thư mục lưu (`download.manifest.sqlite`).
+
+    Lần chạy lại chỉ cần một phép trừ tập hợp trong bộ nhớ thay vì stat từng file;
+    chỉ đối chiếu với file thật khi gọi reconcile(). Bản ghi được ghi theo lô.
+    """
+    FILENAME = "download.manifest.sqlite"
+    FLUSH_EVERY = 500
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.path = os.path.join(output_dir, self.FILENAME)
+        self._lock = threading.Lock()
+        self._pending = []
+        self._db = None
+
+    def _conn(self):
+        if self._db is None:
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            db.execute("CREATE TABLE IF NOT EXISTS done (url TEXT PRIMARY KEY, path TEXT, size INTEGER, "
+                       "etag TEXT, last_modified TEXT, ts REAL)")
+            self._db = db
+        return self._db
+
+    def urls(self):
+        with self._lock:
+            return {row[0] for row in self._conn().execute("SELECT url FROM done")}
+
+    def record(self, url, filename, headers=None):
+        try:
+            size = os.path.getsize(filename)
+        except OSError:
+            return
+        headers = headers or {}
+        row = (url, os.path.relpath(filename, self.output_dir), size,
+               headers.get("ETag"), headers.get("Last-Modified"), time.time())
+        with self._lock:
+            self._pending.append(row)
+            if len(self._pending) >= self.FLUSH_EVERY:
+                self._flush_locked()
+
+    def _flush_locked(self):
+        if self._pending:
+            db = self._conn()
+            with db:
+                db.executemany("INSERT OR REPLACE INTO done VALUES (?, ?, ?, ?, ?, ?)", self._pending)
+            self._pending = []
+
+    def forget(self, urls):
+        """Xóa bản ghi các URL (file hỏng cần tải lại)."""
+        urls = set(urls)
+        with self._lock:
+            self._pending = [row for row in self._pending if row[0] not in urls]
+            db = self._conn()
+            with db:
+                db.executemany("DELETE FROM done WHERE url=?", [(url,) for url in urls])
+
+    def close(self):
+        with self._lock:
+            try:
+                self._flush_locked()
+            except sqlite3.Error:
+                pass
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def reconcile(self):
+        """Đối chiếu với file trên đĩa (mỗi thư mục một lần scandir), bỏ URL có file đã mất hoặc sai kích thước.
+
+        Trả về (số bản ghi còn giữ, số bản ghi bị bỏ).
+        """
+        with self._lock:
+            self._flush_locked()
+            rows = self._conn().execute("SELECT url, path, size FROM done").fetchall()
+        sizes = {}
+        for rel_dir in {os.path.dirname(path) for _url, path, _size in rows}:
+            try:
+                with os.scandir(os.path.join(self.output_dir, rel_dir)) as it:
+                    for entry in it:
+                        if entry.is_file():
+                            sizes[os.path.join(rel_dir, entry.name)] = entry.stat().st_size
+            except OSError:
+                pass
+        stale = [(url,) for url, path, size in rows if sizes.get(path) != size]
+        with self._lock:
+            db = self._conn()
+            with db:
+                db.executemany("DELETE FROM done WHERE url=?", stale)
+        return len(rows) - len(stale), len(stale)
+
+
+class _AsyncResponse:
+    """Body của một response HTTP/1.1 đọc trên asyncio stream (Content-Length, chunked hoặc tới khi đóng)."""
+
+    def __init__(self, reader, status, reason, headers, timeout):
+        self.reader = reader
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.timeout = timeout
+        self.chunked = "chunked" in headers.get("Transfer-Encoding", "").lower()
+        length = headers.get("Content-Length")
+        self.length = int(length) if (length and length.isdigit() and not self.chunked) else None
+        if status in (204, 304) or 100 <= status < 200:
+            self.length = 0
+        self.will_close = (headers.get("Connection", "").lower() == "close"
+                           or (self.length is None and not self.chunked))
+        self.done = self.length == 0
+        self._chunk_left = 0
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+    async def _io(self, coro):
+        return await asyncio.wait_for(coro, self.timeout)
+
+    async def read(self, n=-1):
+        if n is None or n < 0:
+            parts = []
+            while chunk := await self.read(DownloaderApp.CHUNK_SIZE):
+                parts.append(chunk)
+            return b"".join(parts)
+        if self.done:
+            return b""
+        if self.chunked:
+            if self._chunk_left == 0:
+                line = await self._io(self.reader.readline())
+                size = int(line.split(b";")[0].strip() or b"0", 16)
+                if size == 0:
+                    while (await self._io(self.reader.readline())) not in (b"\r\n", b"\n", b""):
+                        pass
+                    self.done = True
+                    return b""
+                self._chunk_left = size
+            data = await self._io(self.reader.read(min(n, self._chunk_left)))
+            if not data:
+                raise http.client.IncompleteRead(b"", self._chunk_left)
+            self._chunk_left -= len(data)
+            if self._chunk_left == 0:
+                await self._io(self.reader.readexactly(2))
+            return data
+        if self.length is None:
+            data = await self._io(self.reader.read(n))
+            self.done = not data
+            return data
+        data = await self._io(self.reader.read(min(n, self.length)))
+        if not data:
+            raise http.client.IncompleteRead(b"", self.length)
+        self.length -= len(data)
+        self.done = self.length == 0
+        return data
+
+
+class AsyncHttpClient:
+    """Client HTTP/1.1 tối giản trên asyncio: giữ kết nối keep-alive và giới hạn số request đồng thời theo host.
+
+    Proxy lấy như ConnectionPool (HTTP(S)_PROXY / NO_PROXY); đường hầm CONNECT cho HTTPS mở trên luồng phụ.
+    """
+    MAX_REDIRECTS = 5
+
+    def __init__(self, per_host=8, headers=None, proxies=None):
+        self.per_host = max(1, per_host)
+        self.headers = headers or {}
+        self.proxies = urllib.request.getproxies() if proxies is None else proxies
+        self._idle = {}
+        self._sems = {}
+
+    def _semaphore(self, key):
+        if key not in self._sems:
+            self._sems[key] = asyncio.Semaphore(self.per_host)
+        return self._sems[key]
+
+    async def _connect(self, key, timeout, proxy):
+        scheme, host, port = key
+        ssl_ctx = ssl.create_default_context() if scheme == "https" else None
+        if proxy is None:
+            return await asyncio.wait_for(asyncio.open_connection(host, port, ssl=ssl_ctx), timeout)
+        if ssl_ctx is None:
+            return await asyncio.wait_for(asyncio.open_connection(proxy.host, proxy.port), timeout)
+        loop = asyncio.get_running_loop()
+        sock = await loop.run_in_executor(None, open_tunnel, proxy, host, port, timeout)
+        try:
+            return await asyncio.wait_for(
+                asyncio.open_connection(sock=sock, ssl=ssl_ctx, server_hostname=host), timeout)
+        except BaseException:
+            sock.close()
+            raise
+
+    async def _send(self, key, path, headers, timeout, proxy=None):
+        scheme, host, port = key
+        while True:
+            idle = self._idle.get(key)
+            reused = bool(idle)
+            if reused:
+                reader, writer = idle.pop()
+            else:
+                reader, writer = await self._connect(key, timeout, proxy)
+            default_port = 443 if scheme == "https" else 80
+            lines = [f"GET {path} HTTP/1.1", f"Host: {host}" + ("" if port == default_port else f":{port}")]
+            lines += [f"{k}: {v}" for k, v in headers.items()]
+            try:
+                writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+                await asyncio.wait_for(writer.drain(), timeout)
+                head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout)
+            except (asyncio.IncompleteReadError, ConnectionError) as e:
+                writer.close()
+                # Kết nối keep-alive cũ đã bị server đóng -> mở kết nối mới
+                if reused:
+                    continue
+                raise http.client.RemoteDisconnected(str(e)) from e
+            except BaseException:
+                writer.close()
+                raise
+            status_line, _, header_block = head.partition(b"\r\n")
+            parts = status_line.decode("latin-1").split(" ", 2)
+            if len(parts) < 2 or not parts[1].isdigit():
+                writer.close()
+                raise http.client.BadStatusLine(status_line.decode("latin-1"))
+            resp_headers = http.client.parse_headers(io.BytesIO(header_block))
+            resp = _AsyncResponse(reader, int(parts[1]), parts[2] if len(parts) > 2 else "", resp_headers, timeout)
+            return writer, resp
+
+    def _finish(self, key, writer, resp):
+        if resp.done and not resp.will_close:
+            self._idle.setdefault(key, []).append((resp.reader, writer))
+        else:
+            writer.close()
+
+    @asynccontextmanager
+    async def open(self, url, timeout, headers=None):
+        for _ in range(self.MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            scheme = parts.scheme.lower()
+            key = (scheme, parts.hostname, parts.port or (443 if scheme == "https" else 80))
+            proxy = proxy_for(scheme, parts.hostname, self.proxies)
+            req_headers = {**self.headers, **(headers or {})}
+            if proxy and scheme == "http":
+                req_headers.update(proxy.headers)
+            async with self._semaphore(key):
+                writer, resp = await self._send(key, request_target(parts, proxy), req_headers, timeout, proxy)
+                if resp.status in (301, 302, 303, 307, 308) and resp.getheader("Location"):
+                    await resp.read()
+                    self._finish(key, writer, resp)
+                    url = urllib.parse.urljoin(url, resp.getheader("Location"))
+                    continue
+                if resp.status >= 400:
+                    await resp.read()
+                    self._finish(key, writer, resp)
+                    raise urllib.error.HTTPError(url, resp.status, resp.reason, resp.headers, None)
+                try:
+                    yield resp
+                except BaseException:
+                    writer.close()
+                    raise
+                self._finish(key, writer, resp)
+                return
+        raise urllib.error.URLError(f"Quá nhiều chuyển hướng: {url}")
+
+    def close(self):
+        for conns in self._idle.values():
+            for _reader, writer in conns:
+                writer.close()
+        self._idle.clear()
+
+
+class JobBatch:
+    """Các ảnh cần tải của một hệ máy: chỉ giữ tên (interned), URL ghép từ base_url lúc duyệt.
+
+    Duyệt ra các job (platform, save_dir, url) như trước, nhưng không giữ sẵn hàng triệu
+    chuỗi URL / tuple cho cả lượt chạy.
+    """
+    __slots__ = ("platform", "save_dir", "base_url", "names")
+
+    def __init__(self, platform, save_dir, base_url, names):
+        self.platform = platform
+        self.save_dir = save_dir
+        self.base_url = base_url
+        self.names = names
+
+    def url(self, name):
+        return f"{self.base_url}{name}.png"
+
+    def urls(self):
+        return map(self.url, self.names)
+
+    def without(self, urls):
+        """Bản sao bỏ các ảnh có URL trong tập `urls` (manifest, cache 404)."""
+        if not urls:
+            return self
+        return JobBatch(self.platform, self.save_dir, self.base_url,
+                        [name for name in self.names if self.url(name) not in urls])
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        platform, save_dir = self.platform, self.save_dir
+        for name in self.names:
+            yield platform, save_dir, self.url(name)
+
+
+class AsyncDownloadEngine:
+    """Engine tải ảnh bằng asyncio: hàng trăm request trên một luồng, giới hạn theo host bằng semaphore.
+
+    Giữ nguyên ngữ nghĩa hủy / thử lại / timeout / ghi đè của DownloaderApp.download_file.
+    """
+
+    def __init__(self, app, max_inflight=256, per_host=8):
+        self.app = app
+        self.max_inflight = max(1, max_inflight)
+        self.per_host = per_host
+        self._slots = None  # asyncio.Condition báo có chỗ trống trong AdaptiveLimiter, tạo trên event loop đang chạy
+
+    async def _acquire_slot(self, limiter):
+        """Giữ một chỗ của limiter; coroutine chờ được đánh thức khi có release() thay vì thăm dò. False nếu hủy."""
+        if self._slots is None:
+            self._slots = asyncio.Condition()
+        async with self._slots:
+            while not limiter.try_acquire():
+                if self.app.cancel_event.is_set():
+                    return False
+                try:
+                    # Chờ có giới hạn để vẫn thấy hủy (cancel_event không đánh thức được Condition)
+                    await asyncio.wait_for(self._slots.wait(), 0.2)
+                except asyncio.TimeoutError:
+                    pass
+            return True
+
+    async def _release_slot(self, limiter, *sample):
+        limiter.release(*sample)
+        async with self._slots:
+            # Đánh thức đủ số coroutine cho các chỗ đang trống (AIMD có thể vừa nâng giới hạn)
+            self._slots.notify(max(1, limiter.limit - limiter.inflight))
+
+    async def download_file(self, client, url, save_dir, force, retries, timeout, fsync=False):
+        app = self.app
+        if app.cancel_event.is_set():
+            return "Đã hủy"
+        filename = os.path.join(save_dir, url.split("/")[-1])
+        exists = os.path.exists(filename)
+        if (not force) and exists:
+            app._record_done(url, filename)
+            return f"Bỏ qua (tồn tại): {os.path.basename(filename)}"
+        part = PartialFile(filename)
+
+        limiter, policy = app.limiter, app.retry_policy
+        host = urllib.parse.urlsplit(url).hostname
+        for attempt in range(1, retries + 1):
+            while (wait := policy.wait_time(host)) > 0:
+                if not await self._sleep(min(wait, 1.0)):
+                    return "Đã hủy"
+            if app.cancel_event.is_set():
+                return "Đã hủy"
+            if limiter and not await self._acquire_slot(limiter):
+                return "Đã hủy"
+            headers = part.request_headers() or (
+                app.http_cache.conditional_headers(url, need_body=False) if exists else {})
+            started, ok, nbytes, throttled = time.monotonic(), True, 0, False
+            try:
+                async with client.open(url, timeout, headers=headers) as resp:
+                    app.metrics.status(resp.status)
+                    policy.record_success(host)
+                    if resp.status == 304:
+                        await resp.read()
+                        app.http_cache.touch(url)
+                        app._record_done(url, filename, resp.headers)
+                        return f"Không đổi (304): {os.path.basename(filename)}"
+                    nbytes = await self._write_stream(resp, part, fsync)
+                    app.metrics.count("bytes", nbytes)
+                    app.http_cache.store(url, resp.headers)
+                    app._record_done(url, filename, resp.headers)
+                return f"OK: {os.path.basename(filename)}"
+            except InterruptedError:
+                return "Đã hủy"
+            except Exception as e:
+                ok, throttled = classify_for_limiter(e)
+                if isinstance(e, InvalidImage):
+                    app.metrics.count("invalid_images")
+                if isinstance(e, urllib.error.HTTPError):
+                    app.metrics.status(e.code)
+                    if e.code == 416:
+                        part.discard()
+                if classify_error(e) == PERMANENT:
+                    policy.record_success(host)
+                    return app._permanent_failure(url, filename, e)
+                policy.record_failure(host, e)
+                if attempt >= retries:
+                    return f"Lỗi: {os.path.basename(filename)} -> {str(e) or type(e).__name__}"
+                app.metrics.count("retries")
+                delay = policy.delay(attempt, e)
+            finally:
+                app.metrics.add_time("image_download", time.monotonic() - started)
+                if limiter:
+                    await self._release_slot(limiter, time.monotonic() - started, ok, nbytes, throttled)
+            if not await self._sleep(delay):
+                return "Đã hủy"
+
+    async def _sleep(self, seconds):
+        """Ngủ `seconds` giây nhưng dậy sớm khi bị hủy; False nếu đã hủy."""
+        deadline = time.monotonic() + seconds
+        while (remaining := deadline - time.monotonic()) > 0:
+            if self.app.cancel_event.is_set():
+                return False
+            await asyncio.sleep(min(remaining, 0.2))
+        return not self.app.cancel_event.is_set()
+
+    async def _write_stream(self, resp, part, fsync):
+        part.begin(resp)
+        try:
+            while True:
+                if self.app.cancel_event.is_set():
+                    raise InterruptedError("Đã hủy")
+                chunk = await resp.read(DownloaderApp.CHUNK_SIZE)
+                if not chunk:
+                    break
+                part.write(chunk)
+            part.seal(fsync)
+            validator = self.app.validator
+            if validator and part.filename.lower().endswith(".png"):
+                # Kiểm tra ở process pool, event loop vẫn chạy các download khác
+                if reason := await asyncio.wrap_future(validator.submit(part.path)):
+                    part.reject(reason)
+            return part.commit()
+        finally:
+            part.close()
+
+    def run(self, job_batches, on_done, force, retries, timeout, fsync=False):
+        """Chạy các job ((platform, save_dir, url)) trên một event loop; gọi on_done(platform, kết quả).
+
+        `job_batches` là iterable các lô job (JobBatch / list), có thể là generator chặn (đang chờ tải XML):
+        nó được rút ở luồng phụ nên event loop vẫn tải các job đã có trong lúc chờ.
+        """
+        async def main():
+            client = AsyncHttpClient(self.per_host, headers={'User-Agent': 'Mozilla/5.0'})
+            loop = asyncio.get_running_loop()
+            self._slots = asyncio.Condition()
+            inbox = asyncio.Queue(maxsize=self.max_inflight * 2)
+            batches = iter(job_batches)
+            end = object()
+
+            async def feeder():
+                try:
+                    while not self.app.cancel_event.is_set():
+                        batch = await loop.run_in_executor(None, next, batches, end)
+                        if batch is end:
+                            break
+                        for job in batch:
+                            await inbox.put(job)
+                finally:
+                    for _ in range(self.max_inflight):
+                        await inbox.put(end)
+
+            async def worker():
+                # max_inflight worker cùng rút từ hàng đợi -> số request đang chạy không vượt max_inflight
+                while (job := await inbox.get()) is not end:
+                    if self.app.cancel_event.is_set():
+                        continue
+                    platform, save_dir, url = job
+                    try:
+                        res = await self.download_file(client, url, save_dir, force, retries, timeout, fsync)
+                    except Exception as e:
+                        res = f"Lỗi: {os.path.basename(url)} -> {e}"
+                    on_done(platform, res)
+
+            try:
+                await asyncio.gather(feeder(), *(worker() for _ in range(self.max_inflight)))
+            finally:
+                client.close()
+
+        asyncio.run(main())
+
+
+# -----------------------
+# Sự kiện từ luồng nền gửi về luồng Tk
+# -----------------------
+Discovered = namedtuple("Discovered", "platform count")
+PlatformsLoaded = namedtuple("PlatformsLoaded", "names")
+AuditSummary = namedtuple("AuditSummary", "checked bad")
+ReconcileDone = namedtuple("ReconcileDone", "")
+
+# Tùy chọn của một lượt tải, chụp trên luồng Tk: luồng nền không được đọc biến Tk
+RunSettings = namedtuple("RunSettings", "force retries timeout workers fsync adaptive engine "
+                                        "async_inflight per_host reprobe validate")
 
 class DownloaderApp:
     GITHUB_HASH_API = "https://api.github.com/repos/mamedev/mame/contents/hash"
+    CHUNK_SIZE = 64 * 1024
+    DISCOVERY_WORKERS = 6
 
     def __init__(self, root):
         self.root = root
         self.root.title("📥 Tải ảnh từ XML (MAME Hash)")
-        self.root.geometry("900x560")
+        self.root.geometry("900x760")
         self.root.resizable(False, False)
         self.root.configure(bg="#f5f6f5")
 
         # ====== STATE ======
         self.output_dir = os.path.dirname(os.path.abspath(__file__))  # mặc định thư mục chứa file .py
-        self.cancel_event = threading.Event()
+        self._init_core()
         self.executor = None
         self.total_tasks = 0
         self.completed_tasks = 0
+        self.audit_summary = None
         self.start_time = None
+        self.master_log_path = None
         self.retries = 3
         self.timeout = 20
 
@@ -112,6 +1055,37 @@ class DownloaderApp:
         ttk.Checkbutton(middle, text="Tải lại (ghi đè nếu tồn tại)", variable=self.force_var).grid(row=rowi, column=0, columnspan=2, sticky="w", padx=8, pady=6)
         rowi += 1
 
+        self.fsync_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(middle, text="Đồng bộ xuống đĩa (fsync)", variable=self.fsync_var).grid(row=rowi, column=0, columnspan=2, sticky="w", padx=8, pady=6)
+        rowi += 1
+
+        self.adaptive_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(middle, text="Tự điều chỉnh số kết nối (AIMD)", variable=self.adaptive_var).grid(row=rowi, column=0, columnspan=2, sticky="w", padx=8, pady=6)
+        rowi += 1
+
+        self.reprobe_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(middle, text="Thử lại cả ảnh đã ghi nhận 404", variable=self.reprobe_var).grid(row=rowi, column=0, columnspan=2, sticky="w", padx=8, pady=6)
+        rowi += 1
+
+        self.validate_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(middle, text="Kiểm tra PNG sau khi tải (CRC)", variable=self.validate_var).grid(row=rowi, column=0, columnspan=2, sticky="w", padx=8, pady=6)
+        rowi += 1
+
+        ttk.Label(middle, text="Engine tải:").grid(row=rowi, column=0, sticky="w", padx=8, pady=6)
+        self.engine_var = tk.StringVar(value="threads")
+        ttk.Combobox(middle, textvariable=self.engine_var, values=("threads", "asyncio"), state="readonly", width=8).grid(row=rowi, column=1, sticky="w")
+        rowi += 1
+
+        ttk.Label(middle, text="Kết nối async (tổng):").grid(row=rowi, column=0, sticky="w", padx=8, pady=6)
+        self.async_inflight_var = tk.IntVar(value=256)
+        ttk.Spinbox(middle, from_=1, to=1000, textvariable=self.async_inflight_var, width=6).grid(row=rowi, column=1, sticky="w")
+        rowi += 1
+
+        ttk.Label(middle, text="Kết nối async / host:").grid(row=rowi, column=0, sticky="w", padx=8, pady=6)
+        self.per_host_var = tk.IntVar(value=16)
+        ttk.Spinbox(middle, from_=1, to=256, textvariable=self.per_host_var, width=6).grid(row=rowi, column=1, sticky="w")
+        rowi += 1
+
         # ---- Cột phải: điều khiển ----
         right = tk.LabelFrame(main, text="Điều khiển", bg="#f5f6f5")
         right.grid(row=1, column=2, sticky="nsew", padx=(6,0))
@@ -121,6 +1095,10 @@ class DownloaderApp:
         self.start_btn.pack(fill="x", padx=8, pady=(8,6))
         self.cancel_btn = ttk.Button(right, text="⏹️ Hủy", style="Danger.TButton", command=self.cancel_download, state=tk.DISABLED)
         self.cancel_btn.pack(fill="x", padx=8, pady=(0,8))
+        self.reconcile_btn = ttk.Button(right, text="🧹 Đối soát manifest", command=self.reconcile_manifest)
+        self.reconcile_btn.pack(fill="x", padx=8, pady=(0,8))
+        self.audit_btn = ttk.Button(right, text="🩺 Kiểm tra ảnh đã tải", command=self.audit_images)
+        self.audit_btn.pack(fill="x", padx=8, pady=(0,8))
 
         self.status_label = ttk.Label(right, text="Chờ bắt đầu…")
         self.status_label.pack(fill="x", padx=8, pady=4)
@@ -130,6 +1108,9 @@ class DownloaderApp:
         self.progress = ttk.Progressbar(right, orient="horizontal", mode="determinate", length=260)
         self.progress.pack(fill="x", padx=8, pady=(0,8))
 
+        self.stats_label = ttk.Label(right, text="", font=("Segoe UI", 8), wraplength=260, justify="left")
+        self.stats_label.pack(fill="x", padx=8, pady=(0,8))
+
         # ---- Log ----
         log_frame = tk.LabelFrame(main, text="Nhật ký", bg="#f5f6f5")
         log_frame.grid(row=2, column=0, columnspan=3, sticky="nsew", pady=(8,0))
@@ -141,6 +1122,37 @@ class DownloaderApp:
         sb.pack(side="right", fill="y")
         self.log_text.configure(yscrollcommand=sb.set)
 
+        self.ui = UiChannel(self.root, self.log_text, self._update_progress_ui, readonly=True,
+                            handlers={Started: self._on_started, Discovered: self._on_discovered,
+                                      ItemResult: self._on_item_result, Finished: self._on_finished,
+                                      AuditSummary: self._on_audit_summary, PlatformsLoaded: self._populate_platforms,
+                                      ReconcileDone: lambda event: self.set_controls_running(False)})
+        self.ui.start()
+
+    def _init_core(self, cache_dir=CACHE_DIR):
+        """Trạng thái của phần tải (không cần Tk), dùng chung cho giao diện và headless()."""
+        self.cancel_event = threading.Event()
+        self.pool = ConnectionPool(headers={'User-Agent': 'Mozilla/5.0'})
+        self.http_cache = HttpCache(os.path.join(cache_dir, "http"))
+        self.limiter = None
+        self.retry_policy = RetryPolicy()
+        self.validator = None
+        self.manifest = None
+        self.negative_cache = NegativeCache(os.path.join(cache_dir, "missing.sqlite"))
+        self.known_missing = set()
+        self.metrics = RunMetrics("download")
+
+    @classmethod
+    def headless(cls, cache_dir=None, output_dir=None):
+        """DownloaderApp không có giao diện, chỉ dùng download_file / AsyncDownloadEngine (vd. script đo hiệu năng).
+
+        `cache_dir` thay cho CACHE_DIR (cache HTTP, cache 404) để chạy không đụng tới cache thật.
+        """
+        app = cls.__new__(cls)
+        app._init_core(cache_dir or CACHE_DIR)
+        app.output_dir = output_dir
+        return app
+
     # ====== UI Helpers ======
     def choose_folder(self):
         directory = filedialog.askdirectory()
@@ -151,82 +1163,169 @@ class DownloaderApp:
     def load_platforms(self):
         def _task():
             try:
-                opener = urllib.request.build_opener()
-                opener.addheaders = [('User-Agent', 'Mozilla/5.0')]
-                with opener.open(self.GITHUB_HASH_API, timeout=20) as resp:
-                    import json
-                    data = json.loads(resp.read().decode('utf-8'))
+                with self.metrics.stage("github_listing"):
+                    data = json.loads(self._fetch_cached(self.GITHUB_HASH_API, timeout=20).decode('utf-8'))
                 xmls = [item['name'] for item in data if item.get('name','').endswith('.xml')]
                 xmls.sort()
-                self.root.after(0, lambda: self._populate_platforms(xmls))
+                self.ui.publish(PlatformsLoaded(xmls))
                 self.log(f"Nạp {len(xmls)} file XML từ GitHub thành công.")
             except Exception as e:
                 self.log(f"Không thể nạp danh sách từ GitHub: {e}")
         threading.Thread(target=_task, daemon=True).start()
 
-    def _populate_platforms(self, xml_list):
+    def _populate_platforms(self, event):
         self.platform_list.delete(0, tk.END)
-        for name in xml_list:
+        for name in event.names:
             self.platform_list.insert(tk.END, name)
 
     def log(self, msg):
-        self.log_text.config(state=tk.NORMAL)
-        self.log_text.insert(tk.END, msg + "\n")
-        self.log_text.see(tk.END)
-        self.log_text.config(state=tk.DISABLED)
+        # An toàn khi gọi từ luồng nền: chỉ đẩy vào hàng đợi, luồng Tk sẽ chèn theo lô
+        self.ui.log(msg)
 
     def set_controls_running(self, running: bool):
-        self.start_btn.config(state=tk.DISABLED if running else tk.NORMAL)
+        # Mỗi lúc chỉ một lượt (tải / kiểm tra / đối soát): các lượt dùng chung cancel_event, manifest, validator...
+        for btn in (self.start_btn, self.audit_btn, self.reconcile_btn):
+            btn.config(state=tk.DISABLED if running else tk.NORMAL)
         self.cancel_btn.config(state=tk.NORMAL if running else tk.DISABLED)
 
     # ====== Networking / Parsing ======
-    def get_image_urls(self, platform_xml_name: str):
+    def _fetch_cached(self, url: str, timeout: int, retries: int = 3) -> bytes:
+        """Tải `url` qua cache HTTP + retry policy của app (dùng bản cache khi server trả 304, hủy được)."""
+        return fetch_url(url, timeout, retries, self.metrics, self.http_cache, self.retry_policy,
+                         self.cancel_event, user_agent="Mozilla/5.0")
+
+    def _open_cached(self, url: str, timeout: int, retries: int = 3):
+        """Như _fetch_cached nhưng trả về file đã mở (body chép theo khối vào cache HTTP) để parse theo luồng."""
+        return open_url(url, timeout, retries, self.metrics, self.http_cache, self.retry_policy,
+                        self.cancel_event, user_agent="Mozilla/5.0")
+
+    def _media_base(self, xml_name: str) -> str:
+        return self.platform_media_base.get(xml_name, f"http://adb.arcadeitalia.net/media/mess.current/ingames/{xml_name}/")
+
+    def get_image_names(self, platform_xml_name: str, timeout: int = 20):
+        """(tên hệ máy, base_url, danh sách tên software) của một XML; URL ảnh là base_url + tên + ".png"."""
         xml_url = f"https://raw.githubusercontent.com/mamedev/mame/refs/heads/master/hash/{platform_xml_name}"
         xml_filename = os.path.basename(xml_url)
         xml_name = os.path.splitext(xml_filename)[0]
 
-        base_url = self.platform_media_base.get(xml_name, f"http://adb.arcadeitalia.net/media/mess.current/ingames/{xml_name}/")
+        base_url = self._media_base(xml_name)
 
         try:
-            opener = urllib.request.build_opener()
-            opener.addheaders = [('User-Agent', 'Mozilla/5.0')]
-            with opener.open(xml_url, timeout=self.timeout_var.get()) as response:
-                xml_content = response.read()
-            tree = ElementTree.parse(io.BytesIO(xml_content))
-            root = tree.getroot()
-            image_urls = []
-            for sw in root.findall("software"):
-                name = sw.get("name")
-                if name:
-                    image_urls.append(f"{base_url}{name}.png")
-            return xml_name, base_url, image_urls
+            with self.metrics.stage("xml_download"):
+                xml_file = self._open_cached(xml_url, timeout=timeout)
+            names = []
+            with xml_file, self.metrics.stage("xml_parse"):
+                for sw in iter_xml_elements(xml_file, "software", depth=1):
+                    name = sw.get("name")
+                    if name:
+                        names.append(sys.intern(name))
+            return xml_name, base_url, names
         except Exception as e:
             self.log(f"[LỖI] Không thể tải/đọc {platform_xml_name}: {e}")
             return xml_name, base_url, []
 
-    def download_file(self, url: str, save_dir: str, force: bool, retries: int, timeout: int):
+    def _write_stream(self, resp, part: PartialFile, fsync: bool):
+        """Ghi body theo từng khối vào `<tên>.part`, chỉ đổi tên sang file đích khi tải đủ.
+
+        Bị ngắt giữa chừng (lỗi mạng, hủy) thì phần đã tải được giữ lại để lần sau tiếp tục bằng Range.
+        """
+        part.begin(resp)
+        try:
+            while True:
+                if self.cancel_event.is_set():
+                    raise InterruptedError("Đã hủy")
+                chunk = resp.read(self.CHUNK_SIZE)
+                if not chunk:
+                    break
+                part.write(chunk)
+            part.seal(fsync)
+            # Trang lỗi HTML / body bị cắt không bao giờ thành <tên>.png (lần thử sau tải lại)
+            if self.validator and part.filename.lower().endswith(".png"):
+                if reason := self.validator.check(part.path):
+                    part.reject(reason)
+            return part.commit()
+        finally:
+            part.close()
+
+    def download_file(self, url: str, save_dir: str, force: bool, retries: int, timeout: int, fsync: bool = False):
         if self.cancel_event.is_set():
             return "Đã hủy"
         filename = os.path.join(save_dir, url.split("/")[-1])
-        if (not force) and os.path.exists(filename):
+        exists = os.path.exists(filename)
+        if (not force) and exists:
+            self._record_done(url, filename)
             return f"Bỏ qua (tồn tại): {os.path.basename(filename)}"
+        part = PartialFile(filename)
 
+        limiter, policy = self.limiter, self.retry_policy
+        host = urllib.parse.urlsplit(url).hostname
         for attempt in range(1, retries + 1):
-            if self.cancel_event.is_set():
+            # Breaker của host đang mở -> chờ ở đây, không tiêu lượt thử
+            if not policy.wait(host, self.cancel_event):
                 return "Đã hủy"
+            if limiter and not limiter.acquire(self.cancel_event):
+                return "Đã hủy"
+            # Có phần tải dở -> tiếp tục bằng Range; tải lại khi đã có file -> chỉ cần server xác nhận 304
+            headers = part.request_headers() or (
+                self.http_cache.conditional_headers(url, need_body=False) if exists else {})
+            started, ok, nbytes, throttled = time.monotonic(), True, 0, False
             try:
-                opener = urllib.request.build_opener()
-                opener.addheaders = [('User-Agent', 'Mozilla/5.0')]
-                with opener.open(url, timeout=timeout) as resp:
-                    data = resp.read()
-                with open(filename, 'wb') as f:
-                    f.write(data)
+                with self.pool.open(url, timeout=timeout, headers=headers) as resp:
+                    self.metrics.status(resp.status)
+                    policy.record_success(host)
+                    if resp.status == 304:
+                        resp.read()
+                        self.http_cache.touch(url)
+                        self._record_done(url, filename, resp.headers)
+                        return f"Không đổi (304): {os.path.basename(filename)}"
+                    nbytes = self._write_stream(resp, part, fsync)
+                    self.metrics.count("bytes", nbytes)
+                    self.http_cache.store(url, resp.headers)
+                    self._record_done(url, filename, resp.headers)
                 return f"OK: {os.path.basename(filename)}"
+            except InterruptedError:
+                return "Đã hủy"
             except Exception as e:
-                if attempt < retries:
-                    time.sleep(1.0 * attempt)
-                else:
+                ok, throttled = classify_for_limiter(e)
+                if isinstance(e, InvalidImage):
+                    self.metrics.count("invalid_images")
+                if isinstance(e, urllib.error.HTTPError):
+                    self.metrics.status(e.code)
+                    if e.code == 416:
+                        # Range không còn hợp lệ với file trên server -> bỏ phần dở, lần sau tải lại từ đầu
+                        part.discard()
+                if classify_error(e) == PERMANENT:
+                    # 4xx nghĩa là host vẫn trả lời bình thường
+                    policy.record_success(host)
+                    return self._permanent_failure(url, filename, e)
+                policy.record_failure(host, e)
+                if attempt >= retries:
                     return f"Lỗi: {os.path.basename(filename)} -> {e}"
+                self.metrics.count("retries")
+                delay = policy.delay(attempt, e)
+            finally:
+                self.metrics.add_time("image_download", time.monotonic() - started)
+                if limiter:
+                    limiter.release(time.monotonic() - started, ok, nbytes, throttled)
+            if self.cancel_event.wait(delay):
+                return "Đã hủy"
+
+    def _record_done(self, url, filename, headers=None):
+        if self.manifest:
+            try:
+                self.manifest.record(url, filename, headers)
+            except sqlite3.Error:
+                pass
+        if url in self.known_missing:
+            # Ảnh từng 404 nay đã có (thử lại hoặc hết hạn TTL) -> xóa khỏi cache âm
+            self.negative_cache.forget(url)
+
+    def _permanent_failure(self, url, filename, exc):
+        """Lỗi vĩnh viễn: không thử lại; 404/410 được ghi vào cache âm để các lần sau bỏ qua."""
+        if exc.code in (404, 410):
+            self.negative_cache.add(url, exc.code)
+            return f"Không có ảnh ({exc.code}): {os.path.basename(filename)}"
+        return f"Lỗi: {os.path.basename(filename)} -> {exc}"
 
     # ====== Download Flow ======
     def start_download(self):
@@ -238,23 +1337,66 @@ class DownloaderApp:
             messagebox.showwarning("Thiếu thông tin", "Vui lòng chọn ít nhất một hệ máy (XML).")
             return
 
+        settings = self._snapshot_settings()
+        self._begin_run()
+        threading.Thread(target=self._download_task, args=(selected, settings), daemon=True).start()
+
+    def audit_images(self):
+        """Kiểm tra lại mọi PNG trong thư mục lưu (nhiều tiến trình); file hỏng bị xóa và đưa vào hàng đợi tải lại."""
+        if not self.output_dir:
+            messagebox.showwarning("Thiếu thông tin", "Vui lòng chọn thư mục lưu trước.")
+            return
+        settings = self._snapshot_settings()
+        self._begin_run()
+        threading.Thread(target=self._audit_task, args=(settings,), daemon=True).start()
+
+    def _snapshot_settings(self):
+        """Đọc mọi tùy chọn trên luồng Tk một lần; luồng nền chỉ dùng bản chụp này."""
+        return RunSettings(force=self.force_var.get(), retries=self.retry_var.get(), timeout=self.timeout_var.get(),
+                           workers=self.thread_var.get(), fsync=self.fsync_var.get(),
+                           adaptive=self.adaptive_var.get(), engine=self.engine_var.get(),
+                           async_inflight=self.async_inflight_var.get(), per_host=self.per_host_var.get(),
+                           reprobe=self.reprobe_var.get(), validate=self.validate_var.get())
+
+    def _begin_run(self):
         self.cancel_event.clear()
+        self.audit_summary = None
+        self.metrics.start_run()
         self.set_controls_running(True)
         self.progress.config(value=0, maximum=100)
         self.status_label.config(text="Đang chuẩn bị…")
         self.eta_label.config(text="ETA: —")
         self.log("===== BẮT ĐẦU =====")
 
-        threading.Thread(target=self._download_task, args=(selected,), daemon=True).start()
-
     def cancel_download(self):
         self.cancel_event.set()
         self.log("Yêu cầu hủy tải…")
 
+    def reconcile_manifest(self):
+        """Đối chiếu manifest của thư mục lưu với file thật; ảnh bị xóa/hỏng sẽ được tải lại ở lần sau."""
+        output_dir = self.output_dir
+        self.set_controls_running(True)
+        self.cancel_btn.config(state=tk.DISABLED)
+
+        def _task():
+            manifest = DownloadManifest(output_dir)
+            try:
+                kept, dropped = manifest.reconcile()
+                self.log(f"[MANIFEST] Đối soát xong: giữ {kept}, bỏ {dropped} bản ghi không còn khớp file.")
+            except sqlite3.Error as e:
+                self.log(f"[MANIFEST] Lỗi đối soát: {e}")
+            finally:
+                manifest.close()
+                self.ui.publish(ReconcileDone())
+        threading.Thread(target=_task, daemon=True).start()
+
     def _update_progress_ui(self):
         pct = (self.completed_tasks / self.total_tasks) * 100.0 if self.total_tasks > 0 else 0.0
         self.progress.config(value=pct, maximum=100)
-        self.status_label.config(text=f"Đã xử lý {self.completed_tasks}/{self.total_tasks} ảnh")
+        status = f"Đã xử lý {self.completed_tasks}/{self.total_tasks} ảnh"
+        if self.limiter:
+            status += f" | đồng thời: {self.limiter.limit}"
+        self.status_label.config(text=status)
 
         if self.start_time and self.completed_tasks > 0:
             elapsed = time.time() - self.start_time
@@ -264,74 +1406,319 @@ class DownloaderApp:
             self.eta_label.config(text=f"ETA: {str(timedelta(seconds=int(eta_seconds)))}")
         else:
             self.eta_label.config(text="ETA: —")
+        self.stats_label.config(text=self.metrics.format_panel())
+
+    # Các handler dưới đây chạy trên luồng Tk (UiChannel), nên đếm tiến độ không cần khóa
+    def _on_started(self, event):
+        self.total_tasks = event.total
+        self.completed_tasks = 0
+        self.start_time = time.time()
+        self._update_progress_ui()
+
+    def _on_discovered(self, event):
+        # Tổng số ảnh (và ETA) tăng dần khi từng hệ máy được tải + parse xong
+        self.total_tasks += event.count
+        self.ui.progress()
+
+    def _on_item_result(self, event):
+        self.completed_tasks += 1
+        self.ui.progress()
+
+    def _on_audit_summary(self, event):
+        self.audit_summary = event
+        self.log(f"[AUDIT] Đã kiểm tra {event.checked} ảnh, {event.bad} ảnh hỏng.")
+
+    def _on_finished(self, event):
+        self.set_controls_running(False)
+        if not event.total and self.audit_summary:
+            # Kiểm tra xong mà không có ảnh hỏng nào phải tải lại
+            checked = self.audit_summary.checked
+            self.status_label.config(text=f"✅ Kiểm tra xong: {checked} ảnh hợp lệ")
+            self.log("✅ HOÀN TẤT")
+            messagebox.showinfo("Kết quả", f"Đã kiểm tra {checked} ảnh, không có ảnh hỏng.")
+        elif not event.total:
+            self.status_label.config(text="Không có tác vụ.")
+            self.log("Không có URL để tải.")
+        elif self.cancel_event.is_set():
+            self.status_label.config(text=f"⏹️ Đã hủy: {self.completed_tasks}/{self.total_tasks}")
+            self.log("⏹️ ĐÃ HỦY")
+            messagebox.showinfo("Đã hủy", f"Đã xử lý {self.completed_tasks}/{self.total_tasks} ảnh trước khi hủy.")
+        else:
+            self.status_label.config(text=f"✅ Hoàn tất: {self.completed_tasks}/{self.total_tasks}")
+            self.log("✅ HOÀN TẤT")
+            messagebox.showinfo("Kết quả", f"Hoàn tất tải {self.completed_tasks}/{self.total_tasks} ảnh "
+                                           f"({event.success} tải mới).\nLog: {self.master_log_path}")
+
+    def _on_limit_change(self, limit, reason):
+        self.log(f"[AIMD] Giới hạn đồng thời -> {limit}: {reason}")
+        self.ui.progress()
+
+    def _on_breaker_open(self, host, seconds, reason):
+        self.metrics.count("breaker_open")
+        self.log(f"[BREAKER] Tạm dừng tải từ {host} trong {seconds:.0f}s: {reason}")
+
+    def _discover_jobs(self, selected_xmls, done, missing, discovered, timeout):
+        """Tải + parse XML các hệ máy song song; yield JobBatch của từng hệ máy ngay khi sẵn sàng.
+
+        URL có trong `done` (manifest) hoặc `missing` (cache 404) bị loại. `discovered[0]` cộng dồn số job và
+        Discovered được gửi ngay khi XML của hệ máy parse xong, không chờ engine rút tới lô đó.
+        """
+        workers = max(1, min(self.DISCOVERY_WORKERS, len(selected_xmls)))
+        ex = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="xml")
+        ready = queue.SimpleQueue()
+        count_lock = threading.Lock()
+
+        def collected(fut, platform_xml):
+            # Chạy trên luồng xml vừa xong: lọc lô + cập nhật tổng / ETA, rồi xếp lô cho engine
+            try:
+                batch = None
+                if not fut.cancelled() and not self.cancel_event.is_set():
+                    batch = self._collect_batch(platform_xml, *fut.result(), done, missing)
+                    if batch:
+                        with count_lock:
+                            discovered[0] += len(batch)
+                        self.ui.publish(Discovered(batch.platform, len(batch)))
+                ready.put((batch, None))
+            except Exception as e:
+                ready.put((None, e))
 
-    def _download_task(self, selected_xmls):
-        force = self.force_var.get()
-        retries = self.retry_var.get()
-        timeout = self.timeout_var.get()
-        max_workers = self.thread_var.get()
+        try:
+            for xml in selected_xmls:
+                ex.submit(self.get_image_names, xml, timeout).add_done_callback(
+                    lambda fut, xml=xml: collected(fut, xml))
+            for _ in selected_xmls:
+                if self.cancel_event.is_set():
+                    break
+                batch, error = ready.get()
+                if error is not None:
+                    raise error
+                if batch:
+                    yield batch
+        finally:
+            # Hủy / dừng sớm: bỏ các XML chưa bắt đầu tải
+            ex.shutdown(wait=False, cancel_futures=True)
+
+    def _collect_batch(self, platform_xml, xml_name, base_url, names, done, missing):
+        """JobBatch còn phải tải của một hệ máy (bỏ URL đã có trong manifest / đã biết 404); None nếu XML hỏng."""
+        if not names:
+            self.log(f"[BỎ QUA] {platform_xml}: không lấy được URL ảnh.")
+            return None
+        save_dir = os.path.join(self.output_dir, xml_name)
+        os.makedirs(save_dir, exist_ok=True)
+        pending = JobBatch(xml_name, save_dir, base_url, names).without(done)
+        skipped = len(names) - len(pending)
+        batch = pending.without(missing)
+        absent = len(pending) - len(batch)
+        if skipped:
+            self.metrics.count("manifest_skipped", skipped)
+        if absent:
+            self.metrics.count("negative_skipped", absent)
+        self.log(f"{platform_xml}: {len(names)} ảnh ({skipped} đã có trong manifest, "
+                 f"{absent} đã biết 404) | base: {base_url}")
+        return batch
 
-        all_jobs = []
-        for platform_xml in selected_xmls:
+    def _audit_jobs(self, discovered):
+        """Kiểm tra PNG từng thư mục hệ máy trong thư mục lưu; xóa file hỏng (và bản ghi manifest), yield job tải lại."""
+        try:
+            with os.scandir(self.output_dir) as it:
+                platforms = sorted(entry.name for entry in it if entry.is_dir())
+        except OSError as e:
+            self.log(f"[AUDIT] Không đọc được thư mục lưu: {e}")
+            return
+        checked = bad_total = 0
+        for xml_name in platforms:
             if self.cancel_event.is_set():
-                break
-            xml_name, base_url, image_urls = self.get_image_urls(platform_xml)
-            if not image_urls:
-                self.log(f"[BỎ QUA] {platform_xml}: không lấy được URL ảnh.")
-                continue
+                return
             save_dir = os.path.join(self.output_dir, xml_name)
-            os.makedirs(save_dir, exist_ok=True)
-            for url in image_urls:
-                all_jobs.append((xml_name, save_dir, url))
-            self.log(f"{platform_xml}: {len(image_urls)} ảnh | base: {base_url}")
+            try:
+                with self.metrics.stage("dir_scan"), os.scandir(save_dir) as it:
+                    paths = sorted(entry.path for entry in it if entry.name.lower().endswith(".png") and entry.is_file())
+            except OSError as e:
+                self.log(f"[AUDIT] Không đọc được {save_dir}: {e}")
+                continue
+            if not paths:
+                continue
+            bad = []
+            with self.metrics.stage("validate"):
+                for path, reason in self.validator.map(paths):
+                    if self.cancel_event.is_set():
+                        return
+                    if reason:
+                        bad.append(path)
+                        self.log(f"[AUDIT] {xml_name}/{os.path.basename(path)}: {reason}")
+            checked += len(paths)
+            self.metrics.count("files_validated", len(paths))
+            self.log(f"[AUDIT] {xml_name}: {len(paths)} ảnh, {len(bad)} hỏng (đã kiểm tra {checked}).")
+            if not bad:
+                continue
+            self.metrics.count("invalid_images", len(bad))
+            bad_total += len(bad)
+            batch = JobBatch(xml_name, save_dir, self._media_base(xml_name), [])
+            for path in bad:
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    self.log(f"[AUDIT] Không xóa được {path}: {e}")
+                    continue
+                batch.names.append(os.path.splitext(os.path.basename(path))[0])
+            try:
+                self.manifest.forget(batch.urls())
+            except sqlite3.Error as e:
+                self.log(f"[MANIFEST] Không cập nhật được manifest: {e}")
+            if batch:
+                discovered[0] += len(batch)
+                self.ui.publish(Discovered(xml_name, len(batch)))
+                yield batch
+        self.ui.publish(AuditSummary(checked, bad_total))
 
-        self.total_tasks = len(all_jobs)
-        self.completed_tasks = 0
-        self.start_time = time.time()
-        self.root.after(0, self._update_progress_ui)
-
-        if self.total_tasks == 0:
-            self.root.after(0, lambda: [
-                self.set_controls_running(False),
-                self.status_label.config(text="Không có tác vụ."),
-                self.log("Không có URL để tải."),
-            ])
-            return
+    def _run_job(self, job, force, retries, timeout, fsync):
+        platform, save_dir, url = job
+        return platform, self.download_file(url, save_dir, force, retries, timeout, fsync)
+
+    def _run_threaded(self, job_batches, on_done, max_workers, force, retries, timeout, fsync):
+        """Submit job lấy dần từ generator, tối đa 2 × max_workers job đã submit mà chưa xong.
 
-        master_log_path = os.path.join(self.output_dir, "download.log")
+        Không giữ danh sách future nên bộ nhớ không tăng theo số ảnh; khi hủy, các job còn
+        trong hàng đợi của executor bị bỏ ngay, chỉ chờ các job đang chạy.
+        """
+        window = threading.BoundedSemaphore(max_workers * 2)
+
+        def finished(fut, job):
+            window.release()
+            if fut.cancelled():
+                return
+            # Job lỗi ngoài download_file vẫn phải được báo, nếu không tiến độ thiếu mục và lỗi bị nuốt
+            try:
+                platform, res = fut.result()
+            except Exception as e:
+                platform, res = job[0], f"Lỗi: {os.path.basename(job[2])} -> {e}"
+            try:
+                on_done(platform, res)
+            except Exception as e:
+                self.ui.publish(ItemResult(f"[{platform}] {res} (lỗi báo kết quả: {e})"))
+
+        ex = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="download")
+        try:
+            for batch in job_batches:
+                for job in batch:
+                    # Chờ chỗ trống trong cửa sổ, kiểm tra hủy định kỳ
+                    while not window.acquire(timeout=0.2):
+                        if self.cancel_event.is_set():
+                            break
+                    else:
+                        fut = ex.submit(self._run_job, job, force, retries, timeout, fsync)
+                        fut.add_done_callback(lambda f, job=job: finished(f, job))
+                    if self.cancel_event.is_set():
+                        break
+                if self.cancel_event.is_set():
+                    break
+        finally:
+            ex.shutdown(wait=True, cancel_futures=self.cancel_event.is_set())
+
+    def _prepare_run(self, settings):
+        """Khởi tạo limiter, retry policy, validator và manifest cho một lượt tải."""
+        max_workers = settings.workers
+        self.pool.resize(max_workers)
+        if settings.adaptive:
+            # thread_var / số kết nối async trở thành mức trần, bắt đầu thấp rồi tăng dần
+            ceiling = settings.async_inflight if settings.engine == "asyncio" else max_workers
+            self.limiter = AdaptiveLimiter(min(4, ceiling), maximum=ceiling, on_change=self._on_limit_change)
+            self.log(f"[AIMD] Bắt đầu với {self.limiter.limit} kết nối, trần {ceiling}.")
+        else:
+            self.limiter = None
+        self.retry_policy = RetryPolicy(on_open=self._on_breaker_open)
+        self.validator = PngValidator() if settings.validate else None
+        self.manifest = DownloadManifest(self.output_dir)
+
+    def _audit_task(self, settings):
+        self._prepare_run(settings)
+        if self.validator is None:
+            self.validator = PngValidator()
+        self.log(f"[AUDIT] Kiểm tra PNG trong {self.output_dir} với {self.validator.workers} tiến trình…")
+        self.ui.publish(Started(0))
+        discovered = [0]
+        self._run_jobs(self._audit_jobs(discovered), discovered, settings, export_empty=True)
+
+    def _download_task(self, selected_xmls, settings):
+        force = settings.force
+        self._prepare_run(settings)
+
+        # Ảnh đã có trong manifest được bỏ qua bằng phép trừ tập hợp, không stat từng file
+        done = set()
+        if not force:
+            with self.metrics.stage("manifest"):
+                try:
+                    done = self.manifest.urls()
+                except sqlite3.Error as e:
+                    self.log(f"[MANIFEST] Không đọc được manifest: {e}")
+        # URL đã 404 (còn hạn TTL) cũng bị loại, trừ khi chọn thử lại
+        try:
+            self.known_missing = self.negative_cache.load()
+        except sqlite3.Error as e:
+            self.log(f"[404] Không đọc được cache âm: {e}")
+            self.known_missing = set()
+        missing = set() if settings.reprobe else self.known_missing
+
+        # Tổng số ảnh chưa biết trước: bắt đầu từ 0 và tăng theo sự kiện Discovered
+        self.ui.publish(Started(0))
+        discovered = [0]
+        self._run_jobs(self._discover_jobs(selected_xmls, done, missing, discovered, settings.timeout), discovered,
+                       settings)
+
+    def _run_jobs(self, job_batches, discovered, settings, export_empty=False):
+        """Tải các job từ generator `job_batches` bằng engine đã chọn, ghi log / số đo và báo kết quả.
+
+        `export_empty`: vẫn xuất số đo khi không có job nào (lượt kiểm tra không thấy ảnh hỏng).
+        """
+        force, retries, timeout, fsync = settings.force, settings.retries, settings.timeout, settings.fsync
+        max_workers = settings.workers
+
+        self.master_log_path = os.path.join(self.output_dir, "download.log")
         try:
-            log_f = open(master_log_path, "a", encoding="utf-8")
+            log_f = open(self.master_log_path, "a", encoding="utf-8")
             log_f.write("===== BẮT ĐẦU =====\n")
         except Exception:
             log_f = None
 
-        def on_done(future, platform):
-            res = future.result()
+        log_lock = threading.Lock()
+        ok_count = [0]
+
+        def on_done(platform, res):
+            # Chạy trên luồng worker: chỉ publish sự kiện, việc đếm do luồng Tk làm
             if res:
-                self.root.after(0, lambda: self.log(f"[{platform}] {res}"))
-                if log_f:
-                    try:
-                        log_f.write(f"[{platform}] {res}\n")
-                    except Exception:
-                        pass
-            self.completed_tasks += 1
-            self.root.after(0, self._update_progress_ui)
+                if res.startswith("OK:"):
+                    self.metrics.count("files_ok")
+                elif res.startswith(("Bỏ qua", "Không đổi")):
+                    self.metrics.count("files_skipped")
+                elif res.startswith("Không có ảnh"):
+                    self.metrics.count("files_missing")
+                elif res.startswith("Lỗi"):
+                    self.metrics.count("files_failed")
+                with log_lock:
+                    if res.startswith("OK:"):
+                        ok_count[0] += 1
+                    if log_f:
+                        try:
+                            log_f.write(f"[{platform}] {res}\n")
+                        except Exception:
+                            pass
+            self.ui.publish(ItemResult(f"[{platform}] {res}" if res else None))
 
         try:
-            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as ex:
-                futures = []
-                for platform, save_dir, url in all_jobs:
-                    if self.cancel_event.is_set():
-                        break
-                    fut = ex.submit(self.download_file, url, save_dir, force, retries, timeout)
-                    fut.add_done_callback(lambda f, p=platform: on_done(f, p))
-                    futures.append(fut)
-                for fut in concurrent.futures.as_completed(futures):
-                    if self.cancel_event.is_set():
-                        break
+            if settings.engine == "asyncio":
+                engine = AsyncDownloadEngine(self, settings.async_inflight, settings.per_host)
+                engine.run(job_batches, on_done, force, retries, timeout, fsync)
+            else:
+                self._run_threaded(job_batches, on_done, max_workers, force, retries, timeout, fsync)
         except Exception as e:
-            self.root.after(0, lambda: self.log(f"[LỖI] Executor: {e}"))
+            self.log(f"[LỖI] Executor: {e}")
         finally:
+            job_batches.close()
+            self.pool.close()
+            if self.validator:
+                self.validator.close(cancel=self.cancel_event.is_set())
+            self.negative_cache.flush()
+            self.manifest.close()
             if log_f:
                 try:
                     log_f.write("===== KẾT THÚC =====\n")
@@ -339,17 +1726,17 @@ class DownloaderApp:
                 except Exception:
                     pass
 
-        def _finish():
-            self.set_controls_running(False)
-            if self.cancel_event.is_set():
-                self.status_label.config(text=f"⏹️ Đã hủy: {self.completed_tasks}/{self.total_tasks}")
-                self.log("⏹️ ĐÃ HỦY")
-                messagebox.showinfo("Đã hủy", f"Đã xử lý {self.completed_tasks}/{self.total_tasks} ảnh trước khi hủy.")
-            else:
-                self.status_label.config(text=f"✅ Hoàn tất: {self.completed_tasks}/{self.total_tasks}")
-                self.log("✅ HOÀN TẤT")
-                messagebox.showinfo("Kết quả", f"Hoàn tất tải {self.completed_tasks}/{self.total_tasks} ảnh.\nLog: {master_log_path}")
-        self.root.after(0, _finish)
+        if not discovered[0] and not export_empty:
+            # Không có job: handler Finished trên luồng Tk báo "Không có tác vụ."
+            self.ui.publish(Finished(0, 0))
+            return
+
+        try:
+            paths = self.metrics.export(self.output_dir, "download")
+            self.log(f"[METRICS] Đã ghi {', '.join(os.path.basename(p) for p in paths)}")
+        except OSError as e:
+            self.log(f"[METRICS] Không ghi được số đo: {e}")
+        self.ui.publish(Finished(ok_count[0], discovered[0]))
 
 def main():
     root = tk.Tk()
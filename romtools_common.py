@@ -0,0 +1,749 @@
+"""Phần dùng chung của các công cụ: cache HTTP / DAT / thư mục nguồn, thử lại, tải HTTP,
+parse XML theo luồng, chuyển file, kiểm tra PNG và số đo hiệu năng.
+
+Các script (copy và đổi tên, copy no-intro, download ảnh) import từ đây thay vì giữ bản sao riêng.
+"""
+import os, re, errno, shutil, tempfile, threading, time, hashlib, sqlite3, zlib, random, json, struct, email.utils
+import urllib.request, urllib.error, urllib.parse
+import xml.etree.ElementTree as ET
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
+
+# -----------------------
+# Cache trên đĩa (HTTP, kết quả parse DAT, chỉ mục thư mục nguồn)
+# -----------------------
+class HttpCache:
+    """Cache HTTP trên đĩa: lưu ETag/Last-Modified (kèm nội dung nếu cần) để gửi request có điều kiện.
+
+    Chỉ mục nằm trong SQLite; khi vượt `max_bytes` hoặc `max_entries` thì xóa
+    các mục lâu không dùng nhất (LRU). Tổng dung lượng / số mục do trigger giữ
+    ngay trong DB, nên các script cùng dùng `.cache/http` thấy cùng một số liệu.
+    """
+    def __init__(self, root, max_bytes=256 * 1024 * 1024, max_entries=200_000):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._db = None
+
+    def _conn(self):
+        if self._db is None:
+            os.makedirs(self.root, exist_ok=True)
+            db = sqlite3.connect(os.path.join(self.root, "http.sqlite"), check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.execute("CREATE TABLE IF NOT EXISTS entries (url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, "
+                           "size INTEGER, has_body INTEGER, atime REAL)")
+                db.execute("CREATE TABLE IF NOT EXISTS stats (id INTEGER PRIMARY KEY CHECK (id = 0), "
+                           "total INTEGER, count INTEGER)")
+                db.execute("INSERT OR IGNORE INTO stats SELECT 0, COALESCE(SUM(size), 0), COUNT(*) FROM entries")
+                db.execute("CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN "
+                           "UPDATE stats SET total = total + new.size, count = count + 1; END")
+                db.execute("CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN "
+                           "UPDATE stats SET total = total - old.size, count = count - 1; END")
+                db.execute("CREATE TRIGGER IF NOT EXISTS entries_resize AFTER UPDATE OF size ON entries BEGIN "
+                           "UPDATE stats SET total = total + new.size - old.size; END")
+                db.execute("COMMIT")
+            except sqlite3.Error:
+                db.execute("ROLLBACK")
+                raise
+            self._db = db
+        return self._db
+
+    def _body_path(self, url):
+        return os.path.join(self.root, hashlib.sha1(url.encode("utf-8")).hexdigest() + ".body")
+
+    def conditional_headers(self, url, need_body=True):
+        with self._lock:
+            row = self._conn().execute("SELECT etag, last_modified, has_body FROM entries WHERE url=?", (url,)).fetchone()
+        if not row or (need_body and not row[2]):
+            return {}
+        headers = {}
+        if row[0]:
+            headers["If-None-Match"] = row[0]
+        if row[1]:
+            headers["If-Modified-Since"] = row[1]
+        return headers
+
+    def load(self, url):
+        """Đọc nội dung đã cache (sau khi server trả 304) và đánh dấu vừa dùng."""
+        try:
+            with open(self._body_path(url), "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        self.touch(url)
+        return data
+
+    def open_body(self, url):
+        """Như load() nhưng trả về file đã mở để đọc theo luồng; None nếu bản cache đã mất."""
+        try:
+            f = open(self._body_path(url), "rb")
+        except OSError:
+            return None
+        self.touch(url)
+        return f
+
+    def touch(self, url):
+        with self._lock:
+            self._conn().execute("UPDATE entries SET atime=? WHERE url=?", (time.time(), url))
+
+    def store(self, url, headers, body=None):
+        etag, last_modified = headers.get("ETag"), headers.get("Last-Modified")
+        if not etag and not last_modified:
+            self.forget(url)
+            return
+        size = 0
+        if body is not None:
+            path = self._body_path(url)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(body)
+            os.replace(tmp_path, path)
+            size = len(body)
+        self._record(url, etag, last_modified, size, body is not None)
+
+    def store_stream(self, url, headers, stream, chunk_size=64 * 1024):
+        """Như store() nhưng chép body từ `stream` theo từng khối, không giữ cả body trong bộ nhớ.
+
+        Trả về file đã mở (ở đầu file) để đọc lại; không có ETag/Last-Modified thì là file tạm, tự xóa khi đóng.
+        """
+        etag, last_modified = headers.get("ETag"), headers.get("Last-Modified")
+        if not etag and not last_modified:
+            self.forget(url)
+            f = tempfile.TemporaryFile()
+            try:
+                shutil.copyfileobj(stream, f, chunk_size)
+                f.seek(0)
+            except BaseException:
+                f.close()
+                raise
+            return f
+        path = self._body_path(url)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                shutil.copyfileobj(stream, f, chunk_size)
+                size = f.tell()
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        # Mở trước khi ghi chỉ mục: lượt dọn LRU trong _record không xóa mất file đang cần đọc
+        f = open(path, "rb")
+        self._record(url, etag, last_modified, size, True)
+        return f
+
+    def _record(self, url, etag, last_modified, size, has_body):
+        with self._lock:
+            # UPSERT (không phải INSERT OR REPLACE) để trigger cập nhật stats chạy đúng
+            self._conn().execute(
+                "INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(url) DO UPDATE SET etag=excluded.etag, "
+                "last_modified=excluded.last_modified, size=excluded.size, has_body=excluded.has_body, "
+                "atime=excluded.atime", (url, etag, last_modified, size, int(has_body), time.time()))
+            self._evict_locked()
+
+    def forget(self, url):
+        with self._lock:
+            self._delete_locked(url)
+
+    def _delete_locked(self, url):
+        db = self._conn()
+        row = db.execute("SELECT size, has_body FROM entries WHERE url=?", (url,)).fetchone()
+        if not row:
+            return
+        db.execute("DELETE FROM entries WHERE url=?", (url,))
+        if row[1]:
+            try:
+                os.remove(self._body_path(url))
+            except OSError:
+                pass
+
+    def _evict_locked(self):
+        db = self._conn()
+        total, count = db.execute("SELECT total, count FROM stats").fetchone()
+        if total <= self.max_bytes and count <= self.max_entries:
+            return
+        # Xóa dần từ mục cũ nhất, để lại 10% khoảng trống để không phải dọn liên tục
+        target_bytes, target_count = self.max_bytes * 0.9, self.max_entries * 0.9
+        for url, size in db.execute("SELECT url, size FROM entries ORDER BY atime").fetchall():
+            if total <= target_bytes and count <= target_count:
+                break
+            self._delete_locked(url)
+            total, count = total - size, count - 1
+
+HTTP_CACHE = HttpCache(os.path.join(CACHE_DIR, "http"))
+
+class ParsedDatCache:
+    """Cache kết quả parse DAT trên đĩa (SQLite), khóa theo blob sha của GitHub.
+
+    Mỗi bản ghi lưu dạng cột (mỗi trường trong `__slots__` của kiểu bản ghi một
+    danh sách) rồi nén zlib; giữ tối đa `max_entries` bản mới nhất.
+    """
+    def __init__(self, path, max_entries=200):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._db = None
+
+    def _conn(self):
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            db.execute("CREATE TABLE IF NOT EXISTS parsed (sha TEXT, variant TEXT, payload BLOB, created REAL, "
+                       "PRIMARY KEY (sha, variant))")
+            self._db = db
+        return self._db
+
+    def get(self, sha, variant, record_type):
+        try:
+            with self._lock:
+                row = self._conn().execute("SELECT payload FROM parsed WHERE sha=? AND variant=?", (sha, variant)).fetchone()
+            if not row:
+                return None
+            data = json.loads(zlib.decompress(row[0]))
+            if data["fields"] != list(record_type.__slots__):
+                return None
+            return [record_type(*values) for values in zip(*data["columns"])]
+        except (sqlite3.Error, zlib.error, ValueError, KeyError):
+            return None
+
+    def put(self, sha, variant, records, record_type):
+        fields = record_type.__slots__
+        payload = zlib.compress(json.dumps({
+            "fields": fields,
+            "columns": [[getattr(r, f) for r in records] for f in fields],
+        }, ensure_ascii=False).encode("utf-8"))
+        try:
+            with self._lock:
+                db = self._conn()
+                db.execute("INSERT OR REPLACE INTO parsed VALUES (?, ?, ?, ?)", (sha, variant, payload, time.time()))
+                db.execute("DELETE FROM parsed WHERE rowid NOT IN "
+                           "(SELECT rowid FROM parsed ORDER BY created DESC LIMIT ?)", (self.max_entries,))
+        except sqlite3.Error:
+            pass
+
+DAT_CACHE = ParsedDatCache(os.path.join(CACHE_DIR, "dat.sqlite"))
+
+class SourceIndex:
+    """Chỉ mục thư mục nguồn (scandir), lưu giữa các lần chạy kèm size/mtime từng file.
+
+    Chỉ quét lại khi mtime của thư mục đổi, và chỉ chuẩn hóa tên các file mới thêm.
+    Lối tắt này chỉ dùng để liệt kê file: ghi đè tại chỗ không đổi mtime thư mục nên size/mtime
+    trả về có thể cũ -> nơi cần chúng để kiểm tra cache (vd. HashDatabase) phải tự stat lại.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = None
+
+    def _conn(self):
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            db.execute("CREATE TABLE IF NOT EXISTS dirs (dir TEXT PRIMARY KEY, mtime_ns INTEGER)")
+            db.execute("CREATE TABLE IF NOT EXISTS entries (dir TEXT, name TEXT, size INTEGER, mtime_ns INTEGER, "
+                       "norm TEXT, PRIMARY KEY (dir, name))")
+            self._db = db
+        return self._db
+
+    def scan(self, directory, log_callback=None):
+        """Trả về danh sách (path, size, mtime_ns, tên chuẩn hóa) của các file trong `directory`."""
+        directory = os.path.abspath(directory)
+        dir_mtime = os.stat(directory).st_mtime_ns
+        with self._lock:
+            db = self._conn()
+            row = db.execute("SELECT mtime_ns FROM dirs WHERE dir=?", (directory,)).fetchone()
+            stored = {name: (size, mtime_ns, norm) for name, size, mtime_ns, norm in
+                      db.execute("SELECT name, size, mtime_ns, norm FROM entries WHERE dir=?", (directory,))}
+
+        if row and row[0] == dir_mtime:
+            entries = stored
+            if log_callback:
+                log_callback(f"Chỉ mục nguồn: {len(entries)} file (không đổi, dùng cache).")
+        else:
+            entries = {}
+            with os.scandir(directory) as it:
+                for entry in it:
+                    try:
+                        if not entry.is_file():
+                            continue
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    old = stored.get(entry.name)
+                    norm = old[2] if old else normalize_text(os.path.splitext(entry.name)[0])
+                    entries[entry.name] = (st.st_size, st.st_mtime_ns, norm)
+
+            removed = stored.keys() - entries.keys()
+            changed = [(directory, name, *value) for name, value in entries.items() if stored.get(name) != value]
+            with self._lock:
+                db = self._conn()
+                with db:
+                    db.executemany("DELETE FROM entries WHERE dir=? AND name=?", [(directory, name) for name in removed])
+                    db.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)", changed)
+                    db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?)", (directory, dir_mtime))
+            if log_callback:
+                added = len(entries.keys() - stored.keys())
+                log_callback(f"Chỉ mục nguồn: {len(entries)} file (+{added} / -{len(removed)}).")
+
+        return [(os.path.join(directory, name), size, mtime_ns, norm)
+                for name, (size, mtime_ns, norm) in sorted(entries.items())]
+
+SOURCE_INDEX = SourceIndex(os.path.join(CACHE_DIR, "source.sqlite"))
+
+# -----------------------
+# Thử lại: phân loại lỗi, backoff + jitter, circuit breaker theo host
+# -----------------------
+PERMANENT, THROTTLED, TRANSIENT = "permanent", "throttled", "transient"
+
+def classify_error(exc):
+    """Phân loại lỗi tải: PERMANENT (4xx, thử lại vô ích), THROTTLED (429/503, hết hạn mức GitHub) hoặc TRANSIENT (mạng, 5xx...)."""
+    if isinstance(exc, urllib.error.HTTPError):
+        if exc.code in (429, 503):
+            return THROTTLED
+        # GitHub báo hết hạn mức bằng 403 + X-RateLimit-Remaining: 0
+        if exc.code == 403 and exc.headers is not None and exc.headers.get("X-RateLimit-Remaining") == "0":
+            return THROTTLED
+        # 408 (timeout) và 416 (Range hỏng, đã bỏ phần dở) thử lại được
+        if 400 <= exc.code < 500 and exc.code not in (408, 416):
+            return PERMANENT
+    return TRANSIENT
+
+def retry_after_seconds(exc):
+    """Số giây server yêu cầu chờ (Retry-After: giây hoặc ngày HTTP; X-RateLimit-Reset của GitHub), None nếu không có."""
+    headers = getattr(exc, "headers", None)
+    if headers is None:
+        return None
+    value = (headers.get("Retry-After") or "").strip()
+    if value.isdigit():
+        return float(value)
+    if value:
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+    reset = (headers.get("X-RateLimit-Reset") or "").strip()
+    if headers.get("X-RateLimit-Remaining") == "0" and reset.isdigit():
+        return max(0.0, int(reset) - time.time())
+    return None
+
+class RetryPolicy:
+    """Thử lại dùng chung: backoff mũ + full jitter và circuit breaker theo host.
+
+    Server báo thời gian chờ (Retry-After / X-RateLimit-Reset) thì theo đúng thời gian đó.
+    Host lỗi `threshold` lần liên tiếp (hoặc bị giới hạn tốc độ) thì breaker mở: mọi request
+    tới host đó chờ tới hết hạn, sau đó chỉ cho một request dò đi trước (half-open).
+    Mỗi lần breaker mở gọi on_open(host, số giây, lý do).
+    """
+    MAX_HINT = 3600.0
+
+    def __init__(self, base=0.5, cap=30.0, threshold=5, open_seconds=30.0, on_open=None):
+        self.base = base
+        self.cap = cap
+        self.threshold = threshold
+        self.open_seconds = open_seconds
+        self.on_open = on_open
+        self._lock = threading.Lock()
+        self._hosts = {}  # host -> [lỗi liên tiếp, mở tới (monotonic), lúc bắt đầu request dò]
+
+    def delay(self, attempt, exc=None):
+        """Số giây chờ trước lần thử kế tiếp (attempt tính từ 1)."""
+        hint = retry_after_seconds(exc)
+        if hint is not None:
+            # Thêm chút jitter để các worker không cùng dậy một lúc
+            return min(hint, self.MAX_HINT) + random.uniform(0, self.base)
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+    def wait_time(self, host):
+        """0 nếu được gửi request tới host ngay, ngược lại là số giây nên chờ rồi hỏi lại."""
+        with self._lock:
+            state = self._hosts.get(host)
+            if state is None or not state[1]:
+                return 0.0
+            remaining = state[1] - time.monotonic()
+            if remaining > 0:
+                return remaining
+            now = time.monotonic()
+            # Request dò bị hủy / không báo kết quả thì sau open_seconds cho request khác dò thay
+            if state[2] and now - state[2] < self.open_seconds:
+                return 0.2
+            state[2] = now
+            return 0.0
+
+    def wait(self, host, cancel_event=None):
+        """Chặn tới khi breaker của host cho qua; False nếu bị hủy trong lúc chờ."""
+        while (delay := self.wait_time(host)) > 0:
+            if cancel_event is not None:
+                if cancel_event.wait(min(delay, 1.0)):
+                    return False
+            else:
+                time.sleep(min(delay, 1.0))
+        return cancel_event is None or not cancel_event.is_set()
+
+    def record_success(self, host):
+        with self._lock:
+            self._hosts.pop(host, None)
+
+    def record_failure(self, host, exc=None):
+        """Ghi một lần lỗi tạm thời / bị chặn; mở breaker khi đủ ngưỡng hoặc server yêu cầu chờ."""
+        hint = retry_after_seconds(exc)
+        with self._lock:
+            state = self._hosts.setdefault(host, [0, 0.0, 0.0])
+            state[0] += 1
+            state[2] = 0.0
+            if hint is None and state[0] < self.threshold:
+                return
+            seconds = min(hint, self.MAX_HINT) if hint is not None else self.open_seconds
+            until = time.monotonic() + seconds
+            if until <= state[1]:
+                return
+            state[1] = until
+            reason = "server yêu cầu chờ" if hint is not None else f"{state[0]} lỗi liên tiếp"
+        if self.on_open:
+            self.on_open(host, seconds, reason)
+
+RETRY_POLICY = RetryPolicy()
+
+# -----------------------
+# Tải HTTP
+# -----------------------
+def fetch_url(url, timeout=30, retries=3, metrics=None, http_cache=None, policy=None, cancel_event=None,
+              user_agent="python-urllib/3"):
+    """Tải `url` bằng request có điều kiện (http_cache) và thử lại theo `policy`.
+
+    Mặc định dùng HTTP_CACHE / RETRY_POLICY; `cancel_event` được set thì raise InterruptedError.
+    """
+    return _request(url, timeout, retries, metrics, http_cache, policy, cancel_event, user_agent, False)
+
+def open_url(url, timeout=30, retries=3, metrics=None, http_cache=None, policy=None, cancel_event=None,
+             user_agent="python-urllib/3"):
+    """Như fetch_url nhưng trả về file nhị phân đã mở (người gọi đóng).
+
+    Body được chép theo khối 64 KiB vào file của cache HTTP rồi đọc lại từ đĩa, nên XML lớn
+    parse được theo luồng (iter_xml_elements) mà không giữ cả file trong bộ nhớ.
+    """
+    return _request(url, timeout, retries, metrics, http_cache, policy, cancel_event, user_agent, True)
+
+def _request(url, timeout, retries, metrics, http_cache, policy, cancel_event, user_agent, stream):
+    http_cache = HTTP_CACHE if http_cache is None else http_cache
+    policy = RETRY_POLICY if policy is None else policy
+    host = urllib.parse.urlsplit(url).hostname
+    attempt = 0
+    while True:
+        # Breaker của host đang mở (vd. hết hạn mức GitHub) -> chờ, không tiêu lượt thử
+        if not policy.wait(host, cancel_event):
+            raise InterruptedError("Đã hủy")
+        headers = {"User-Agent": user_agent, **http_cache.conditional_headers(url)}
+        req = urllib.request.Request(url, headers=headers)
+        try:
+            with urllib.request.urlopen(req, timeout=timeout) as resp:
+                if stream:
+                    data = http_cache.store_stream(url, resp.headers, resp)
+                    size = os.fstat(data.fileno()).st_size
+                else:
+                    data = resp.read()
+                    size = len(data)
+                    http_cache.store(url, resp.headers, data)
+                if metrics:
+                    metrics.status(resp.status)
+                    metrics.count("xml_bytes", size)
+                policy.record_success(host)
+                return data
+        except InterruptedError:
+            raise
+        except Exception as e:
+            if isinstance(e, urllib.error.HTTPError):
+                if metrics:
+                    metrics.status(e.code)
+                if e.code == 304:
+                    # 304: nội dung không đổi -> dùng bản cache; nếu bản cache đã mất thì tải lại đầy đủ
+                    policy.record_success(host)
+                    if (data := (http_cache.open_body(url) if stream else http_cache.load(url))) is not None:
+                        return data
+                    http_cache.forget(url)
+                    continue
+            if classify_error(e) == PERMANENT:
+                policy.record_success(host)
+                raise
+            policy.record_failure(host, e)
+            attempt += 1
+            if attempt >= retries:
+                raise
+            if metrics:
+                metrics.count("retries")
+            delay = policy.delay(attempt, e)
+            if cancel_event is None:
+                time.sleep(delay)
+            elif cancel_event.wait(delay):
+                raise InterruptedError("Đã hủy")
+
+def fetch_json(url, metrics=None):
+    return json.loads(fetch_url(url, metrics=metrics).decode("utf-8"))
+
+
+# -----------------------
+# Parse XML theo luồng
+# -----------------------
+def normalize_text(s):
+    if not s:
+        return ""
+    s = s.lower()
+    s = re.sub(r"[^a-z0-9\u00C0-\u024f\s]", " ", s)
+    return re.sub(r"\s+", " ", s).strip()
+
+def iter_xml_elements(source, tag, depth=None, chunk_size=64 * 1024):
+    """Duyệt XML theo luồng (XMLPullParser), yield từng phần tử `tag` rồi giải phóng ngay.
+
+    `source` có thể là str, bytes hoặc file object; `depth=1` chỉ lấy con trực
+    tiếp của gốc. Bộ nhớ chỉ giữ một bản ghi tại một thời điểm.
+    """
+    parser = ET.XMLPullParser(("start", "end"))
+    stack = []
+
+    def chunks():
+        if isinstance(source, (str, bytes)):
+            for i in range(0, len(source), chunk_size):
+                yield source[i:i + chunk_size]
+        else:
+            while chunk := source.read(chunk_size):
+                yield chunk
+
+    def drain():
+        for event, elem in parser.read_events():
+            if event == "start":
+                stack.append(elem)
+                continue
+            stack.pop()
+            if elem.tag == tag and (depth is None or len(stack) == depth):
+                yield elem
+                elem.clear()
+                if stack:
+                    stack[-1].remove(elem)
+
+    for chunk in chunks():
+        parser.feed(chunk)
+        yield from drain()
+    parser.close()
+    yield from drain()
+
+# -----------------------
+# Kiểm tra ảnh PNG (chạy trong tiến trình con của PngValidator)
+# -----------------------
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+def validate_png(path):
+    """Kiểm tra chữ ký PNG, cấu trúc chunk (IHDR đầu tiên, kết thúc bằng IEND) và CRC từng chunk.
+
+    Trả về None nếu hợp lệ, ngược lại là lý do. Đặt ở module import được theo tên để pickle được
+    sang tiến trình con (spawn/forkserver), kể cả khi script gọi nó được nạp qua importlib.
+    """
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError as e:
+        return f"không đọc được file: {e}"
+    if not data.startswith(PNG_SIGNATURE):
+        return "trang HTML, không phải PNG" if data.lstrip()[:1] == b"<" else "sai chữ ký PNG"
+    view = memoryview(data)
+    pos = len(PNG_SIGNATURE)
+    while True:
+        if pos + 12 > len(data):
+            return f"file bị cắt ở byte {pos}"
+        length, ctype = struct.unpack_from(">I4s", data, pos)
+        end = pos + 12 + length
+        name = ctype.decode("latin-1")
+        if end > len(data):
+            return f"chunk {name} bị cắt ở byte {pos}"
+        if pos == len(PNG_SIGNATURE) and ctype != b"IHDR":
+            return f"chunk đầu là {name}, không phải IHDR"
+        if zlib.crc32(view[pos + 4:end - 4]) != struct.unpack_from(">I", data, end - 4)[0]:
+            return f"sai CRC chunk {name} ở byte {pos}"
+        if ctype == b"IEND":
+            return None
+        pos = end
+
+# -----------------------
+# Chế độ chuyển file: copy thường / reflink / kernel / hardlink / symlink
+# -----------------------
+TRANSFER_MODES = ("copy", "reflink", "kernel", "hardlink", "symlink")
+FICLONE = 0x40049409  # ioctl clone file trên Linux (btrfs, XFS)
+# Lỗi thật sự của thao tác (không phải do chế độ không được hỗ trợ) -> không lùi về chế độ khác
+_REAL_ERRNOS = {errno.ENOENT, errno.ENOSPC, errno.EEXIST, errno.EROFS, getattr(errno, "EDQUOT", errno.ENOSPC)}
+_unsupported = set()  # (chế độ, thư mục nguồn, thư mục đích) đã biết là không dùng được
+
+def _copy_kernel(src, dst):
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        infd, outfd = fsrc.fileno(), fdst.fileno()
+        remaining = os.fstat(infd).st_size
+        while remaining > 0:
+            count = min(remaining, 1 << 30)
+            if hasattr(os, "copy_file_range"):
+                sent = os.copy_file_range(infd, outfd, count)
+            elif hasattr(os, "sendfile"):
+                sent = os.sendfile(outfd, infd, None, count)
+            else:
+                raise OSError(errno.ENOSYS, "Không có copy_file_range/sendfile")
+            if sent == 0:
+                break
+            remaining -= sent
+    shutil.copystat(src, dst)
+
+def _copy_reflink(src, dst):
+    if fcntl is None:
+        raise OSError(errno.ENOSYS, "Không hỗ trợ reflink trên hệ điều hành này")
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    shutil.copystat(src, dst)
+
+_TRANSFER_FUNCS = {
+    "copy": shutil.copy2,
+    "reflink": _copy_reflink,
+    "kernel": _copy_kernel,
+    "hardlink": os.link,
+    "symlink": lambda src, dst: os.symlink(os.path.abspath(src), dst),
+}
+_FALLBACKS = {
+    "copy": ("copy",),
+    "reflink": ("reflink", "kernel", "copy"),
+    "kernel": ("kernel", "copy"),
+    "hardlink": ("hardlink", "copy"),
+    "symlink": ("symlink", "copy"),
+}
+
+def transfer_file(src, dst, mode="copy"):
+    """Chuyển `src` sang `dst` theo `mode`, tự lùi về chế độ kế tiếp nếu không được hỗ trợ.
+
+    Trả về chế độ thực sự đã dùng.
+    """
+    for candidate in _FALLBACKS.get(mode, ("copy",)):
+        key = (candidate, os.path.dirname(src), os.path.dirname(dst))
+        if candidate != "copy" and key in _unsupported:
+            continue
+        try:
+            _TRANSFER_FUNCS[candidate](src, dst)
+            return candidate
+        except OSError as e:
+            if candidate == "copy" or e.errno in _REAL_ERRNOS:
+                raise
+            _unsupported.add(key)
+            if candidate in ("reflink", "kernel"):
+                try:
+                    os.remove(dst)
+                except OSError:
+                    pass
+
+# -----------------------
+# Số đo hiệu năng của một lượt chạy (panel trực tiếp + xuất JSON / Prometheus textfile)
+# -----------------------
+class RunMetrics:
+    """Thời gian từng stage, số byte, số file, số lần retry và histogram mã HTTP. Thread-safe.
+
+    Thời gian của stage chạy song song (copy, tải ảnh) là tổng thời gian của các luồng.
+    Thời gian chạy và tốc độ tính từ start_run(), không tính lúc cửa sổ để rảnh; các stage chuẩn bị
+    (`PREP_STAGES`: nạp danh sách, tải / parse XML) vẫn là tổng riêng, cộng vào lượt kế tiếp.
+    """
+    PREP_STAGES = ("github_listing", "xml_download", "xml_parse")
+
+    def __init__(self, tool):
+        self.tool = tool
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self.stages = {}       # stage -> [số lần, số giây]
+        self.counters = {}     # tên -> giá trị
+        self.http_status = {}  # mã HTTP -> số lần
+
+    def start_run(self):
+        """Bắt đầu một lượt chạy: đặt lại mốc thời gian và bộ đếm, chỉ giữ stage chuẩn bị chưa xuất."""
+        with self._lock:
+            self.started = time.time()
+            self.stages = {k: v for k, v in self.stages.items() if k in self.PREP_STAGES}
+            self.counters = {}
+            self.http_status = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            entry = self.stages.setdefault(name, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def status(self, code):
+        with self._lock:
+            self.http_status[code] = self.http_status.get(code, 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            elapsed = max(time.time() - self.started, 1e-9)
+            counters = dict(self.counters)
+            files = sum(v for k, v in counters.items() if k.startswith("files_"))
+            return {
+                "tool": self.tool,
+                "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+                "elapsed_s": round(elapsed, 3),
+                "stages": {k: {"calls": n, "seconds": round(s, 4)} for k, (n, s) in self.stages.items()},
+                "counters": counters,
+                "http_status": {str(k): v for k, v in sorted(self.http_status.items())},
+                "files_per_s": round(files / elapsed, 2),
+                "bytes_per_s": round(counters.get("bytes", 0) / elapsed, 1),
+            }
+
+    def format_panel(self):
+        snap = self.snapshot()
+        stages = " | ".join(f"{k} {v['seconds']:.2f}s" for k, v in snap["stages"].items()) or "—"
+        c = snap["counters"]
+        http = " ".join(f"{k}×{v}" for k, v in snap["http_status"].items()) or "—"
+        return (f"⏱ {stages}\n"
+                f"📦 {c.get('bytes', 0) / (1024 * 1024):.1f} MB, {snap['files_per_s']:.1f} file/s, "
+                f"{snap['bytes_per_s'] / (1024 * 1024):.2f} MB/s | retry {c.get('retries', 0)} | HTTP {http}")
+
+    def export(self, directory, prefix):
+        """Ghi `<prefix>.metrics.json` và `<prefix>.prom` (textfile cho node_exporter) vào `directory`."""
+        snap = self.snapshot()
+        label = f'tool="{self.tool}"'
+        lines = ["# TYPE romtools_run_duration_seconds gauge",
+                 f"romtools_run_duration_seconds{{{label}}} {snap['elapsed_s']}",
+                 "# TYPE romtools_stage_seconds_total counter"]
+        lines += [f'romtools_stage_seconds_total{{{label},stage="{k}"}} {v["seconds"]}' for k, v in snap["stages"].items()]
+        lines.append("# TYPE romtools_stage_calls_total counter")
+        lines += [f'romtools_stage_calls_total{{{label},stage="{k}"}} {v["calls"]}' for k, v in snap["stages"].items()]
+        for name, value in sorted(snap["counters"].items()):
+            lines += [f"# TYPE romtools_{name}_total counter", f"romtools_{name}_total{{{label}}} {value}"]
+        lines.append("# TYPE romtools_http_responses_total counter")
+        lines += [f'romtools_http_responses_total{{{label},code="{k}"}} {v}' for k, v in snap["http_status"].items()]
+
+        paths = []
+        for suffix, text in ((".metrics.json", json.dumps(snap, ensure_ascii=False, indent=2)),
+                             (".prom", "\n".join(lines))):
+            path = os.path.join(directory, prefix + suffix)
+            # Ghi file tạm rồi đổi tên để bộ thu thập không đọc phải file ghi dở
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                f.write(text + "\n")
+            os.replace(path + ".tmp", path)
+            paths.append(path)
+        with self._lock:
+            # Stage chuẩn bị đã nằm trong bản xuất này -> không tính lại cho lượt sau
+            for name in self.PREP_STAGES:
+                self.stages.pop(name, None)
+        return paths
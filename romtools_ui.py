@@ -0,0 +1,103 @@
+"""Phần giao diện Tk dùng chung: sự kiện từ luồng nền và kênh UiChannel rút chúng trên luồng Tk."""
+import queue, threading, time
+from collections import namedtuple
+from tkinter import END, NORMAL, DISABLED
+
+# -----------------------
+# Sự kiện từ luồng nền gửi về luồng Tk
+# -----------------------
+Started = namedtuple("Started", "total")
+Progress = namedtuple("Progress", "current total")
+ItemResult = namedtuple("ItemResult", "text")
+Finished = namedtuple("Finished", "success total")
+LogLine = namedtuple("LogLine", "text")
+
+class UiChannel:
+    """Kênh cập nhật UI: luồng nền đẩy vào hàng đợi, luồng Tk rút ra theo nhịp timer.
+
+    Log được chèn theo lô và chỉ giữ `max_lines` dòng cuối; tiến độ chỉ vẽ lại
+    tối đa `progress_hz` lần/giây (luôn vẽ giá trị mới nhất). Các sự kiện khác
+    (Started, ItemResult, Finished...) được chuyển theo đúng thứ tự cho
+    `handlers[type(event)]`, luôn chạy trên luồng Tk.
+    """
+    def __init__(self, root, text_widget, draw_progress, max_lines=5000, interval_ms=100, progress_hz=10,
+                 readonly=False, handlers=None):
+        self.root = root
+        self.text = text_widget
+        self.draw_progress = draw_progress
+        self.handlers = handlers or {}
+        self.max_lines = max_lines
+        self.interval_ms = interval_ms
+        self.min_redraw = 1.0 / progress_hz
+        self.readonly = readonly
+        self._queue = queue.SimpleQueue()
+        self._progress = None
+        self._progress_lock = threading.Lock()
+        self._last_draw = 0.0
+
+    def start(self):
+        self.root.after(self.interval_ms, self._drain)
+
+    def publish(self, event):
+        """Gọi được từ mọi luồng."""
+        if isinstance(event, Progress):
+            self.progress(*event)
+        else:
+            self._queue.put(event)
+
+    def log(self, msg):
+        self._queue.put(LogLine(msg))
+
+    def progress(self, *args):
+        with self._progress_lock:
+            self._progress = args
+
+    def _drain(self):
+        try:
+            self._drain_once()
+        finally:
+            # Handler lỗi cũng không được làm dừng vòng rút sự kiện
+            self.root.after(self.interval_ms, self._drain)
+
+    def _drain_once(self):
+        lines = []
+        try:
+            while True:
+                event = self._queue.get_nowait()
+                if isinstance(event, (LogLine, ItemResult)) and event.text:
+                    lines.append(event.text)
+                handler = self.handlers.get(type(event))
+                if handler is None:
+                    continue
+                if not isinstance(event, ItemResult):
+                    # Sự kiện mốc (bắt đầu / kết thúc): đưa log và tiến độ đang chờ lên trước
+                    if lines:
+                        self._insert(lines[-self.max_lines:])
+                        lines = []
+                    self._redraw_progress(force=True)
+                handler(event)
+        except queue.Empty:
+            pass
+        if lines:
+            self._insert(lines[-self.max_lines:])
+        self._redraw_progress()
+
+    def _redraw_progress(self, force=False):
+        now = time.monotonic()
+        if force or now - self._last_draw >= self.min_redraw:
+            with self._progress_lock:
+                args, self._progress = self._progress, None
+            if args is not None:
+                self._last_draw = now
+                self.draw_progress(*args)
+
+    def _insert(self, lines):
+        if self.readonly:
+            self.text.config(state=NORMAL)
+        self.text.insert(END, "\n".join(lines) + "\n")
+        excess = int(self.text.index("end-1c").split(".")[0]) - 1 - self.max_lines
+        if excess > 0:
+            self.text.delete("1.0", f"{excess + 1}.0")
+        self.text.see(END)
+        if self.readonly:
+            self.text.config(state=DISABLED)
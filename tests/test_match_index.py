@@ -0,0 +1,71 @@
+"""MatchIndex.find phải trả về đúng như find_match_fast (file đầu tiên theo thứ tự file_map, hoặc None)."""
+import importlib.util
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+def load_script(filename, module_name):
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(ROOT, filename))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+rename = load_script("copy và đổi tên.py", "copy_rename")
+
+FILES = [
+    "Super Mario Bros. 3 (USA).zip",
+    "Super Mario Bros. (World).zip",
+    "Mario Kart 64 (Europe).zip",
+    "Zelda II - The Adventure of Link (USA).zip",
+    "The Legend of Zelda (USA).zip",
+    "Ys (Japan).zip",
+]
+
+class MatchIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.file_map = rename.build_normalized_file_map(FILES)
+        self.index = rename.MatchIndex(self.file_map)
+
+    def assertParity(self, desc, expected):
+        self.assertEqual(rename.find_match_fast(desc, self.file_map), expected)
+        self.assertEqual(self.index.find(desc), expected)
+
+    def test_empty_description_matches_first_file(self):
+        for desc in ("", None, "  ", "!!!"):
+            with self.subTest(desc=desc):
+                self.assertParity(desc, FILES[0])
+
+    def test_shorter_than_gram(self):
+        self.assertLess(len("ys"), rename.MatchIndex.GRAM)
+        self.assertParity("Ys", FILES[5])
+        self.assertParity("3", FILES[0])
+        self.assertParity("ii", FILES[3])
+        self.assertParity("qx", None)
+
+    def test_first_match_in_file_map_order_wins(self):
+        self.assertParity("Super Mario Bros", FILES[0])
+        self.assertParity("Mario", FILES[0])
+        self.assertParity("Zelda", FILES[3])
+        self.assertParity("(USA)", FILES[0])
+        reordered = dict(reversed(list(self.file_map.items())))
+        self.assertEqual(rename.MatchIndex(reordered).find("Mario"), FILES[2])
+        self.assertEqual(rename.find_match_fast("Mario", reordered), FILES[2])
+
+    def test_no_match(self):
+        for desc in ("Metroid", "Mario Kart 8", "zelda iii", "bros 3 super"):
+            with self.subTest(desc=desc):
+                self.assertParity(desc, None)
+
+    def test_empty_file_map(self):
+        index = rename.MatchIndex({})
+        for desc in ("", "ys", "Mario"):
+            with self.subTest(desc=desc):
+                self.assertIsNone(index.find(desc))
+                self.assertIsNone(rename.find_match_fast(desc, {}))
+
+if __name__ == "__main__":
+    unittest.main()
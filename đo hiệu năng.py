@@ -0,0 +1,413 @@
+import os, sys, json, time, random, struct, zlib, shutil, tempfile, threading, argparse, platform, importlib.util, tracemalloc
+import http.server
+from concurrent.futures import ThreadPoolExecutor
+from xml.sax.saxutils import quoteattr, escape
+from romtools_common import SourceIndex
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+WORDS = ("super", "mega", "star", "dragon", "quest", "racing", "soccer", "ninja", "tennis", "puzzle",
+         "legend", "space", "battle", "castle", "world", "hero", "kart", "golf", "fighter", "zone",
+         "adventure", "island", "ghost", "wars", "turbo", "dream", "shadow", "pinball", "baseball", "tower")
+REGIONS = ("USA", "Europe", "Japan", "World", "USA, Europe")
+
+# -----------------------
+# Nạp các script công cụ (tên file có dấu cách nên không import trực tiếp được)
+# -----------------------
+def load_script(filename, module_name):
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(HERE, filename))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module  # để pickle/dataclass tìm được module theo tên
+    spec.loader.exec_module(module)
+    return module
+
+# -----------------------
+# Dữ liệu giả lập: DAT No-Intro, XML hash MAME, thư mục nguồn
+# -----------------------
+def make_titles(n, rng):
+    titles, seen = [], set()
+    while len(titles) < n:
+        words = " ".join(rng.choice(WORDS).capitalize() for _ in range(rng.randint(2, 4)))
+        title = f"{words} {rng.randint(1, 999)}"
+        if title not in seen:
+            seen.add(title)
+            titles.append(title)
+    return titles
+
+def rom_attrs(rng):
+    size = rng.choice((131072, 262144, 524288, 1048576))
+    return f'size="{size}" crc="{rng.getrandbits(32):08x}" sha1="{rng.getrandbits(160):040x}"'
+
+def write_nointro_dat(path, titles, rng, clone_rate=0.2):
+    """DAT kiểu No-Intro: `<game name>` (một phần là clone) kèm `<rom crc sha1 size>`."""
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('<?xml version="1.0"?>\n<datafile>\n<header><name>Bench</name></header>\n')
+        for i, title in enumerate(titles):
+            name = f"{title} ({rng.choice(REGIONS)})"
+            clone = f' cloneof={quoteattr(titles[i - 1])}' if i and rng.random() < clone_rate else ""
+            f.write(f'<game name={quoteattr(name)}{clone}><description>{escape(name)}</description>'
+                    f'<rom name={quoteattr(name + ".bin")} {rom_attrs(rng)}/></game>\n')
+        f.write("</datafile>\n")
+
+def write_mame_dat(path, titles, rng):
+    """XML hash kiểu MAME softwarelist: `<software name>` + `<description>`."""
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('<?xml version="1.0"?>\n<softwarelist name="bench" description="Bench">\n')
+        for i, title in enumerate(titles):
+            f.write(f'<software name="sw{i:06d}"><description>{escape(title)}</description>'
+                    f'<year>{rng.randint(1980, 2005)}</year><publisher>Bench</publisher>'
+                    f'<part name="cart" interface="bench_cart"><dataarea name="rom" size="1">'
+                    f'<rom name="sw{i:06d}.bin" {rom_attrs(rng)} offset="0"/></dataarea></part></software>\n')
+        f.write("</softwarelist>\n")
+
+def make_source_tree(directory, names, rng, hit_rate=0.9, file_size=1024):
+    """Tạo file nguồn cho khoảng `hit_rate` tên (phần còn lại sẽ là MISS), thêm ít file rác không khớp."""
+    os.makedirs(directory, exist_ok=True)
+    payload = os.urandom(file_size)
+    for name in names:
+        if rng.random() < hit_rate:
+            with open(os.path.join(directory, name + ".zip"), "wb") as f:
+                f.write(payload)
+    for i in range(max(1, len(names) // 20)):
+        with open(os.path.join(directory, f"zz junk {i}.zip"), "wb") as f:
+            f.write(payload)
+
+# -----------------------
+# Server HTTP giả lập cho ảnh (độ trễ + tỉ lệ lỗi cấu hình được)
+# -----------------------
+def fake_png(width=4, height=4):
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    raw = b"".join(b"\x00" + b"\x80" * (width * 3) for _ in range(height))
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw)) + chunk(b"IEND", b""))
+
+class FakeImageServer:
+    """ThreadingHTTPServer phục vụ `/img/<tên>.png`; lỗi được chọn theo CRC của đường dẫn nên lặp lại được.
+
+    `/close/...` trả lời kèm `Connection: close`; `peers` ghi cổng client của từng request
+    (mỗi cổng là một kết nối TCP) để kiểm tra keep-alive.
+    """
+    def __init__(self, latency_ms=5.0, error_rate=0.0, body=None):
+        body = body or fake_png()
+        latency = latency_ms / 1000.0
+        error_cutoff = int(error_rate * 10000)
+        peers = self.peers = []
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True  # header và body ghi riêng -> tránh trễ ~40 ms do delayed ACK
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                peers.append(self.client_address[1])
+                if latency:
+                    time.sleep(latency)
+                if zlib.crc32(self.path.encode()) % 10000 < error_cutoff:
+                    self.send_response(503)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "image/png")
+                self.send_header("ETag", '"bench"')
+                self.send_header("Content-Length", str(len(body)))
+                if self.path.startswith("/close/"):
+                    self.send_header("Connection", "close")
+                self.end_headers()
+                self.wfile.write(body)
+
+        class Server(http.server.ThreadingHTTPServer):
+            daemon_threads = True
+            request_queue_size = 1024  # backlog mặc định (5) làm rớt SYN khi nhiều kết nối mở cùng lúc
+
+        self.server = Server(("127.0.0.1", 0), Handler)
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+# -----------------------
+# Đo và tổng hợp
+# -----------------------
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    k = max(0, min(len(sorted_values) - 1, int(round(pct / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[k]
+
+def summarize(count, elapsed, samples, **extra):
+    """`samples` là độ trễ từng mẫu (giây); trả về thông lượng + p50/p99 (ms)."""
+    samples = sorted(samples)
+    ms = lambda v: round(v * 1000.0, 3) if v is not None else None
+    return {"count": count, "seconds": round(elapsed, 4),
+            "throughput_per_s": round(count / elapsed, 1) if elapsed > 0 else None,
+            "p50_ms": ms(percentile(samples, 50)), "p99_ms": ms(percentile(samples, 99)), **extra}
+
+def timed(fn, repeat):
+    samples, result = [], None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        samples.append(time.perf_counter() - start)
+    return result, samples
+
+class NullEvents:
+    def publish(self, event):
+        pass
+
+# -----------------------
+# Các stage
+# -----------------------
+def retained_kb(build):
+    """Bộ nhớ (KB) còn giữ bởi kết quả của build(), đo bằng tracemalloc ngoài phần đo thời gian."""
+    tracemalloc.start()
+    try:
+        result = build()
+        size, _peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return round(size / 1024, 1)
+
+def bench_parse(rename, nointro, nointro_dat, mame_dat, repeat):
+    with open(nointro_dat, encoding="utf-8") as f:
+        nointro_text = f.read()
+    with open(mame_dat, encoding="utf-8") as f:
+        mame_text = f.read()
+    parse_games = lambda: nointro.parse_xml_games(nointro_text, "bios,demo", include_clones=False)
+    games, samples = timed(parse_games, repeat)
+    out = {"parse_xml_games": summarize(len(games) * repeat, sum(samples), samples, unit="run",
+                                        retained_kb=retained_kb(parse_games))}
+    parse_softwares = lambda: rename.parse_xml_softwares(mame_text)
+    softwares, samples = timed(parse_softwares, repeat)
+    out["parse_xml_softwares"] = summarize(len(softwares) * repeat, sum(samples), samples, unit="run",
+                                           retained_kb=retained_kb(parse_softwares))
+    return out, softwares
+
+def parity_queries(descriptions, rng, count):
+    """Truy vấn ngẫu nhiên cho kiểm tra parity: mô tả thật, đoạn con, chuỗi ngắn và chuỗi chắc chắn MISS."""
+    alphabet = "abcdefghijklmnopqrstuvwxyz0123456789 "
+    out = ["", " ", "a", "zz", "qqqqqq"]
+    for _ in range(count):
+        desc = rng.choice(descriptions)
+        kind = rng.randrange(5)
+        if kind == 0:
+            out.append(desc)
+        elif kind == 1:
+            i = rng.randrange(len(desc))
+            out.append(desc[i:i + rng.randint(1, 12)])
+        elif kind == 2:
+            out.append(desc.upper() + " " + rng.choice(WORDS))
+        elif kind == 3:
+            out.append(" ".join(rng.sample(WORDS, rng.randint(1, 3))))
+        else:
+            out.append("".join(rng.choice(alphabet) for _ in range(rng.randint(1, 8))))
+    return out
+
+def check_match_parity(rename, file_map, index, queries):
+    """MatchIndex.find phải trả về đúng như find_match_fast (kể cả None); sai thì AssertionError."""
+    misses = 0
+    for query in queries:
+        expected = rename.find_match_fast(query, file_map)
+        got = index.find(query)
+        if got != expected:
+            raise AssertionError(f"MatchIndex.find({query!r}) = {got!r}, find_match_fast = {expected!r}")
+        misses += expected is None
+    return {"queries": len(queries), "misses": misses}
+
+def bench_match(rename, softwares, source_dir, queries, rng):
+    file_map = rename.build_normalized_file_map(sorted(os.listdir(source_dir)))
+    sample = rng.sample(softwares, min(queries, len(softwares)))
+    start = time.perf_counter()
+    index = rename.MatchIndex(file_map)
+    build = time.perf_counter() - start
+    out = {}
+    for label, find, extra in (("find_match_fast", lambda d: rename.find_match_fast(d, file_map), {}),
+                               ("MatchIndex.find", index.find, {"index_build_s": round(build, 4)})):
+        samples = []
+        for item in sample:
+            start = time.perf_counter()
+            find(item.description)
+            samples.append(time.perf_counter() - start)
+        out[label] = summarize(len(samples), sum(samples), samples, unit="query", **extra)
+    out["match_parity"] = check_match_parity(
+        rename, file_map, index, parity_queries([item.description for item in softwares], rng, queries))
+    return out
+
+def bench_process(rename, nointro, softwares, games, source_dir, work_dir, repeat):
+    out = {}
+    cases = (("CopyRenameProcessor.process",
+              lambda dst, idx: rename.CopyRenameProcessor(source_dir, dst, "bench.xml", softwares, {".zip"},
+                                                          source_index=idx)),
+             ("CopyOnlyProcessor.process",
+              lambda dst, idx: nointro.CopyOnlyProcessor(source_dir, dst, "bench.xml", games, {".zip"},
+                                                         source_index=idx)))
+    for label, make in cases:
+        samples, items = [], 0
+        for i in range(repeat):
+            # Mỗi lượt dùng thư mục đích + chỉ mục nguồn mới -> đo đường "lạnh", lặp lại được
+            run_dir = os.path.join(work_dir, f"{label}-{i}")
+            processor = make(os.path.join(run_dir, "dst"), SourceIndex(os.path.join(run_dir, "source.sqlite")))
+            start = time.perf_counter()
+            _, total = processor.process(NullEvents())
+            samples.append(time.perf_counter() - start)
+            items += total
+            shutil.rmtree(run_dir, ignore_errors=True)
+        out[label] = summarize(items, sum(samples), samples, unit="run")
+    return out
+
+def check_keepalive(downloader):
+    """ConnectionPool phải dùng lại socket giữa các request và mở socket mới sau `Connection: close`."""
+    server = FakeImageServer(latency_ms=0)
+    pool = downloader.ConnectionPool(maxsize=2)
+    try:
+        def get(path):
+            with pool.open(server.base_url + path, 5) as resp:
+                resp.read()
+            return server.peers[-1]
+
+        first = [get(f"/img/keep{i}.png") for i in range(3)]
+        if len(set(first)) != 1:
+            raise AssertionError(f"ConnectionPool không dùng lại kết nối: cổng client {first}")
+        closing = get("/close/keep.png")
+        if closing != first[-1]:
+            raise AssertionError("request trước Connection: close không đi trên kết nối đang mở")
+        reopened = [get(f"/img/reopen{i}.png") for i in range(2)]
+        if reopened[0] == closing or reopened[0] != reopened[1]:
+            raise AssertionError(f"sau Connection: close phải mở một kết nối mới rồi dùng lại nó: "
+                                 f"{closing} -> {reopened}")
+        return {"requests": len(server.peers), "connections": len(set(server.peers))}
+    finally:
+        pool.close()
+        server.close()
+
+def bench_download(downloader, names, work_dir, workers, latency_ms, error_rate, engines, validate=True):
+    out = {"keepalive": check_keepalive(downloader)}
+    server = FakeImageServer(latency_ms, error_rate)
+    try:
+        for engine in engines:
+            save_dir = os.path.join(work_dir, f"img-{engine}")
+            os.makedirs(save_dir, exist_ok=True)
+            # Cache HTTP / cache 404 / thư mục lưu đều nằm trong thư mục tạm: không đụng tới .cache thật
+            app = downloader.DownloaderApp.headless(os.path.join(work_dir, f"cache-{engine}"), save_dir)
+            app.pool.resize(workers)
+            # Kiểm tra PNG qua PngValidator (pool tiến trình) như khi bật "Kiểm tra PNG" trên UI
+            app.validator = downloader.PngValidator() if validate else None
+            urls = [f"{server.base_url}/img/{name}.png" for name in names]
+            samples, results = [], []
+            lock = threading.Lock()
+
+            def one(url):
+                start = time.perf_counter()
+                res = app.download_file(url, save_dir, False, 1, 10)
+                with lock:
+                    samples.append(time.perf_counter() - start)
+                    results.append(res)
+
+            start = time.perf_counter()
+            if engine == "asyncio":
+                class TimedEngine(downloader.AsyncDownloadEngine):
+                    async def download_file(self, *args, **kwargs):
+                        t0 = time.perf_counter()
+                        try:
+                            return await super().download_file(*args, **kwargs)
+                        finally:
+                            samples.append(time.perf_counter() - t0)
+                jobs = [("bench", save_dir, url) for url in urls]
+                TimedEngine(app, workers, workers).run([jobs], lambda _p, res: results.append(res), False, 1, 10)
+            else:
+                with ThreadPoolExecutor(max_workers=workers) as exe:
+                    list(exe.map(one, urls))
+            elapsed = time.perf_counter() - start
+            app.pool.close()
+            if app.validator:
+                app.validator.close()
+            errors = sum(1 for r in results if not (r or "").startswith("OK"))
+            out[f"download_file[{engine}]"] = summarize(len(results), elapsed, samples, unit="request",
+                                                        workers=workers, errors=errors, validate=validate)
+    finally:
+        server.close()
+    return out
+
+# -----------------------
+# Main
+# -----------------------
+def run_scale(scale, args, modules):
+    rename, nointro, downloader = modules
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory(prefix=f"bench-{scale}-") as work_dir:
+        titles = make_titles(scale, rng)
+        nointro_dat = os.path.join(work_dir, "nointro.xml")
+        mame_dat = os.path.join(work_dir, "mame.xml")
+        write_nointro_dat(nointro_dat, titles, rng)
+        write_mame_dat(mame_dat, titles, rng)
+        with open(nointro_dat, encoding="utf-8") as f:
+            games = nointro.parse_xml_games(f.read())
+
+        # Tên file nguồn: kiểu No-Intro (tên game), mô tả MAME nằm trong tên nên cả hai công cụ đều ghép được
+        source_dir = os.path.join(work_dir, "source")
+        make_source_tree(source_dir, [g.name for g in games], rng, args.hit_rate, args.file_size)
+
+        result = {}
+        stages = set(args.stages)
+        softwares = None
+        if stages & {"parse", "match", "process"}:
+            parsed, softwares = bench_parse(rename, nointro, nointro_dat, mame_dat, args.repeat)
+            if "parse" in stages:
+                result.update(parsed)
+        if "match" in stages:
+            result.update(bench_match(rename, softwares, source_dir, args.match_queries, rng))
+        if "process" in stages:
+            result.update(bench_process(rename, nointro, softwares, games, source_dir, work_dir, args.repeat))
+        if "download" in stages:
+            names = [f"sw{i:06d}" for i in range(min(scale, args.max_downloads))]
+            result.update(bench_download(downloader, names, work_dir, args.workers, args.latency_ms,
+                                         args.error_rate, args.engines, not args.no_validate))
+        return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Đo hiệu năng các đường nóng (parse DAT, ghép tên, copy, tải ảnh) "
+                                                 "trên dữ liệu giả lập; in kết quả JSON.")
+    parser.add_argument("--scale", type=int, nargs="+", default=[1000], help="số game/software, vd. 1000 10000 100000")
+    parser.add_argument("--stages", nargs="+", default=["parse", "match", "process", "download"],
+                        choices=["parse", "match", "process", "download"])
+    parser.add_argument("--repeat", type=int, default=3, help="số lượt cho stage parse/process")
+    parser.add_argument("--match-queries", type=int, default=500, help="số mô tả đem tra (find_match_fast là O(n))")
+    parser.add_argument("--hit-rate", type=float, default=0.9, help="tỉ lệ game có file nguồn")
+    parser.add_argument("--file-size", type=int, default=1024, help="kích thước mỗi file nguồn (byte)")
+    parser.add_argument("--max-downloads", type=int, default=2000, help="số ảnh tối đa mỗi engine")
+    parser.add_argument("--workers", type=int, default=16, help="số luồng / kết nối tải")
+    parser.add_argument("--latency-ms", type=float, default=5.0, help="độ trễ server giả lập mỗi request")
+    parser.add_argument("--error-rate", type=float, default=0.01, help="tỉ lệ request trả 503")
+    parser.add_argument("--engines", nargs="+", default=["threads", "asyncio"], choices=["threads", "asyncio"])
+    parser.add_argument("--no-validate", action="store_true", help="tắt kiểm tra PNG khi tải")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output", help="ghi JSON ra file (mặc định chỉ in ra stdout)")
+    args = parser.parse_args(argv)
+
+    modules = (load_script("copy và đổi tên.py", "bench_copy_rename"),
+               load_script("copy no-intro game no cloneof.py", "bench_copy_nointro"),
+               load_script("download ảnh.py", "bench_download"))
+    report = {
+        "meta": {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+                 "platform": platform.platform(), "cpus": os.cpu_count(),
+                 "args": {k: v for k, v in vars(args).items() if k != "output"}},
+        "scales": {},
+    }
+    for scale in args.scale:
+        print(f"[bench] scale={scale} ...", file=sys.stderr)
+        report["scales"][str(scale)] = run_scale(scale, args, modules)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    print(text)
+
+if __name__ == "__main__":
+    main()